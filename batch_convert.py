@@ -0,0 +1,127 @@
+import os, argparse, json, time, shutil, hashlib
+import os.path as osp
+from dicom_utils import dotdict
+from scheduler import run_jobs, warn_failed_jobs
+from csv2rt import process as convert_csv
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="batch_convert",
+        usage="batch_convert path/to/cases/ path/to/converted/",
+        description="""Convert csv annotations of many cases to dicom-rt structure sets.
+        Every sub-directory of the source directory is a case, it is converted into the
+        sub-directory of the target directory with the same name.
+        Completed cases are recorded in a manifest, re-running only converts
+        cases that are missing, failed or whose inputs changed.
+        """
+        )
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of cases converted at the same time')
+    parser.add_argument('--manifest', type=str, default=None,
+                        help='path of the manifest (default: target/manifest.json)')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='number of times a failed case is retried in the same run')
+    return parser.parse_args(argv)
+
+
+def hash_inputs(case_dir):
+    """
+    fingerprint of the input files of a case: relative path, size and modification time.
+    Structure sets and hidden files written by the conversion are not inputs.
+    """
+    sha1 = hashlib.sha1()
+    for root, dirs, files in os.walk(case_dir):
+        dirs.sort()
+        for fn in sorted(files):
+            if fn.startswith('.') or fn.endswith('_rtstruct.dcm'):
+                continue
+            fullpath = osp.join(root, fn)
+            st = os.stat(fullpath)
+            sha1.update(f"{osp.relpath(fullpath, case_dir)}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return sha1.hexdigest()
+
+
+def load_manifest(path):
+    if not osp.isfile(path):
+        return dict()
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    """
+    write the manifest atomically, a crash leaves either the old or the new manifest
+    """
+    os.makedirs(osp.dirname(osp.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def convert_case(job):
+    """
+    convert one case with `csv2rt.process`, a half-written target from an earlier run is removed first
+    """
+    if osp.isdir(job.target):
+        shutil.rmtree(job.target)
+    failures = convert_csv(job.source, job.target, num_workers=1)
+    if len(failures) > 0:
+        raise RuntimeError("; ".join([f"{name}: {reason}" for name, reason in failures]))
+
+
+def process(source, target, num_workers=1, manifest_path=None, retries=1):
+    if manifest_path is None:
+        manifest_path = osp.join(target, "manifest.json")
+    manifest = load_manifest(manifest_path)
+
+    jobs, num_done = [], 0
+    for case in sorted(os.listdir(source)):
+        case_dir = osp.join(source, case)
+        if not osp.isdir(case_dir):
+            continue
+        input_hash = hash_inputs(case_dir)
+        record = manifest.get(case)
+        if record is not None and record["status"] == "done" and record["input_hash"] == input_hash:
+            num_done += 1
+            continue
+        jobs.append(dotdict(case=case, source=case_dir, target=osp.join(target, case), input_hash=input_hash))
+    print(f"{len(jobs)} cases to convert, {num_done} up to date.")
+
+    num_jobs = len(jobs)
+    for attempt in range(retries + 1):
+        failed = []
+        for _, job, _, error in run_jobs(convert_case, jobs, num_workers=num_workers):
+            manifest[job.case] = dict(
+                status="done" if error is None else "failed",
+                input_hash=job.input_hash,
+                error=error,
+                finished=time.strftime("%Y-%m-%d %H:%M:%S"))
+            save_manifest(manifest, manifest_path)
+            if error is not None:
+                failed.append(job)
+        if len(failed) == 0:
+            break
+        jobs = failed
+        if attempt < retries:
+            print(f"Retrying {len(failed)} failed cases.")
+    failures = [(job.case, manifest[job.case]["error"]) for job in jobs if manifest[job.case]["status"] == "failed"]
+    warn_failed_jobs(failures, num_jobs)
+    return failures
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not osp.isdir(args.source):
+        raise RuntimeError(f'{args.source} is not a directory')
+    process(args.source, args.target, num_workers=args.workers,
+            manifest_path=args.manifest, retries=args.retries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,562 @@
+import os, argparse, json, plistlib, platform, shutil, struct, subprocess, sys, tempfile, time, uuid
+import os.path as osp
+import numpy as np
+from warnings import warn
+from dicom_utils import dotdict, group_into_studies
+
+
+def bench_study_planning(workdir, sizes=(8, 16, 32, 64), repeat=3):
+    """
+    time `rtconvert.plan_jobs` (grouping the records into studies included) on cohorts of increasing size.
+    The time per study should stay flat if the pipeline scales linearly.
+    A single cohort of `max(sizes)` studies, each with 3 series of 20 slices and 5 annotated slices,
+    is written by `write_synthetic_cohort` to `workdir` and scanned once, smaller cohorts are its first studies.
+    """
+    from dicom_utils import read_dicom_info
+    from rtconvert import plan_jobs
+    cohort = write_synthetic_cohort(workdir, num_studies=max(sizes), num_series=3, num_slices=20, num_sr=5, size=16)
+    records = read_dicom_info(cohort.dicoms + cohort.osirix_sr)
+    study_uids = list(group_into_studies(records))
+    results = []
+    for num_studies in sizes:
+        included = set(study_uids[:num_studies])
+        subset = [r for r in records if r.StudyInstanceUID in included]
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            plan_jobs(group_into_studies(subset))
+            best = min(best, time.perf_counter() - start)
+        results.append(dict(num_studies=num_studies, seconds=best, seconds_per_study=best / num_studies))
+    return results
+
+
+def bench_json_points(num_points=100000, repeat=3):
+    """
+    time parsing OsiriX `Point_px` strings with `parse_roi.parse_points`
+    against the former `eval` per point.
+    """
+    from parse_roi import parse_points
+    rng = np.random.default_rng(0)
+    points = [f"({x}, {y})" for x, y in rng.uniform(0, 512, size=(num_points, 2)).tolist()]
+    results = dict(num_points=num_points)
+    for name, func in [("eval", lambda: np.array([eval(p) for p in points])),
+                       ("parse_points", lambda: parse_points(points, dim=2))]:
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - start)
+        results[f"{name}_seconds"] = best
+    return results
+
+
+# SOP classes of the synthetic cohort
+MR_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.4"
+BASIC_TEXT_SR_STORAGE = "1.2.840.10008.5.1.4.1.1.88.11"
+SYNTHETIC_ROI_NAMES = ["prostate", "lesion"]
+
+
+def synthetic_polygon(cx, cy, radius, num_points=32):
+    """
+    (num_points, 2) float32 points of a circle in pixel coordinates
+    """
+    t = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+    return np.stack([cx + radius * np.cos(t), cy + radius * np.sin(t)], axis=1).astype(np.float32)
+
+
+# an OsirixSR exported by OsiriX, the synthetic OsirixSR are copies of its EncapsulatedDocument
+OSIRIX_SR_TEMPLATE = osp.join(osp.dirname(osp.abspath(__file__)),
+                              "example", "Prostatex-0000", "OsiriX_ROI_SR", "IM-0002-0000-0001.dcm")
+
+
+def _bplist_ascii(obj):
+    """
+    value of the binary plist object `obj` (bytes starting at its marker) if it is an ascii string, else None
+    """
+    if obj[0] >> 4 != 0x5:
+        return None
+    length, start = obj[0] & 0xF, 1
+    if length == 0xF:
+        nbytes = 1 << (obj[1] & 0xF)
+        length = int.from_bytes(obj[2:2 + nbytes], "big")
+        start = 2 + nbytes
+    return obj[start:start + length].decode("ascii")
+
+
+def _bplist_ascii_object(value):
+    value = value.encode("ascii")
+    if len(value) < 15:
+        return bytes([0x50 | len(value)]) + value
+    if len(value) < 256:
+        return bytes([0x5F, 0x10, len(value)]) + value
+    return bytes([0x5F, 0x11]) + len(value).to_bytes(2, "big") + value
+
+
+def patch_bplist_strings(doc, replace):
+    """
+    binary plist `doc` with every ascii string `s` in `replace` changed to `replace[s]`.
+    All other objects are copied byte by byte, so the object order and references stay those of the writer of `doc`.
+    """
+    offset_size, ref_size, num_objects, top, table = struct.unpack(">6xBBQQQ", doc[-32:])
+    offsets = [int.from_bytes(doc[table + i * offset_size:table + (i + 1) * offset_size], "big") for i in range(num_objects)]
+    order = sorted(range(num_objects), key=offsets.__getitem__)
+    bounds = [offsets[i] for i in order] + [table]
+    out = bytearray(doc[:bounds[0]])
+    for n, i in enumerate(order):
+        obj = doc[bounds[n]:bounds[n + 1]]
+        value = _bplist_ascii(obj)
+        offsets[i] = len(out)
+        out += _bplist_ascii_object(replace[value]) if value in replace else obj
+    table = len(out)
+    if table >= 1 << (8 * offset_size):
+        raise ValueError(f"Patched plist of {table} bytes exceeds the {offset_size} bytes offsets of the original.")
+    for offset in offsets:
+        out += offset.to_bytes(offset_size, "big")
+    out += struct.pack(">6xBBQQQ", offset_size, ref_size, num_objects, top, table)
+    return bytes(out)
+
+
+def osirix_template(path=OSIRIX_SR_TEMPLATE):
+    """
+    EncapsulatedDocument of the single ROI OsirixSR `path` and the strings synthetic OsirixSR replace:
+    the ROI `name`, its `points` ("{x, y}"), `study_uid` and `uuid`
+    """
+    import pydicom
+    if not osp.isfile(path):
+        raise FileNotFoundError(f"OsirixSR template {path} not found, the synthetic OsirixSR are copies of it.")
+    doc = bytes(pydicom.dcmread(path).EncapsulatedDocument)
+    # dicom pads odd-length values with a trailing zero byte
+    offset_size, _, num_objects, _, table = struct.unpack(">6xBBQQQ", doc[-32:])
+    if table + num_objects * offset_size + 32 != len(doc):
+        doc = doc[:-1]
+    archive = plistlib.loads(doc)
+    objects = archive["$objects"]
+
+    def resolve(value):
+        return objects[value.data]
+
+    roi = resolve(resolve(archive["$top"]["root"])["NS.objects"][0])
+    points = [resolve(resolve(p)["$0"]) for p in resolve(roi["points"])["NS.objects"]]
+    if len(set(points)) != len(points):
+        raise ValueError(f"OsirixSR template {path} has duplicate points.")
+    return dotdict(doc=doc, name=resolve(roi["name"]), points=points,
+                   study_uid=resolve(roi["savedStudyInstanceUID"]), uuid=resolve(roi["UUID"]))
+
+
+def osirix_document(template, name, points, study_uid):
+    """
+    EncapsulatedDocument of an OsirixSR with one ROI `name` of (N, 2) `points`, laid out as `template`
+    (see `osirix_template`) so that both the heuristic and the structured parser read it.
+    `points` must have as many points as the template.
+    """
+    if len(points) != len(template.points):
+        raise ValueError(f"The OsirixSR template has {len(template.points)} points, got {len(points)}.")
+    replace = {old: f"{{{x:.14f}, {y:.14f}}}" for old, (x, y) in zip(template.points, points.tolist())}
+    replace.update({template.name: name, template.study_uid: study_uid, template.uuid: str(uuid.uuid4()).upper()})
+    return patch_bplist_strings(template.doc, replace)
+
+
+def _write_dataset(path, ds, sop_class_uid):
+    from pydicom.dataset import FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = sop_class_uid
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.SOPClassUID = sop_class_uid
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+
+
+def write_synthetic_cohort(root, num_studies=2, num_series=2, num_slices=16, num_sr=4, size=128, seed=0):
+    """
+    write a synthetic cohort of `num_studies` studies to `root`. Each study has `num_series` MR series
+    of `num_slices` slices of `size` x `size` pixels, and `num_sr` slices of its first series are annotated
+    with the same ROIs as OsirixSR (`sr/`, one per ROI, copies of `OSIRIX_SR_TEMPLATE`),
+    a csv export (`rois.csv`) and a json export (`rois.json`):
+
+        root/study-<i>/series-<j>/IM-<k>.dcm
+        root/study-<i>/sr/IM-<k>.dcm
+        root/study-<i>/rois.csv
+        root/study-<i>/rois.json
+
+    Annotations stay away from the first and last slice. Returns a dotdict with the paths of every kind.
+    """
+    from pydicom.dataset import Dataset
+    rng = np.random.default_rng(seed)
+    template = osirix_template()
+    cohort = dotdict(root=root, dicoms=[], osirix_sr=[], csvs=[], jsons=[], num_rois=0, num_points=0)
+    for i in range(num_studies):
+        study_uid = f"1.2.826.0.1.{i}"
+        study_dir = osp.join(root, f"study-{i}")
+        annotated = np.unique(np.linspace(1, num_slices - 2, num_sr).round().astype(int)) if num_slices > 2 else []
+        csv_lines, json_images = [], []
+        sr_start = len(cohort.osirix_sr)
+        for j in range(num_series):
+            series_uid = f"{study_uid}.{j}"
+            for k in range(num_slices):
+                ds = Dataset()
+                ds.PatientName = f"Synthetic^{i}"
+                ds.PatientID = f"synthetic-{i}"
+                ds.PatientBirthDate = ""
+                ds.PatientSex = "O"
+                ds.StudyDate = "20240101"
+                ds.StudyTime = "120000"
+                ds.StudyID = str(i)
+                ds.AccessionNumber = ""
+                ds.ReferringPhysicianName = ""
+                ds.Modality = "MR"
+                ds.StudyInstanceUID = study_uid
+                ds.SeriesInstanceUID = series_uid
+                ds.SOPInstanceUID = f"{series_uid}.{k}"
+                ds.FrameOfReferenceUID = f"{study_uid}.1000"
+                ds.SeriesDescription = f"series-{j}"
+                ds.SeriesNumber = j + 1
+                ds.InstanceNumber = k + 1
+                ds.ImagePositionPatient = [0., 0., 3. * k]
+                ds.ImageOrientationPatient = [1., 0., 0., 0., 1., 0.]
+                ds.PixelSpacing = [1., 1.]
+                ds.SliceThickness = 3.
+                ds.SliceLocation = 3. * k
+                ds.Rows = ds.Columns = size
+                ds.SamplesPerPixel = 1
+                ds.PhotometricInterpretation = "MONOCHROME2"
+                ds.BitsAllocated = 16
+                ds.BitsStored = 12
+                ds.HighBit = 11
+                ds.PixelRepresentation = 0
+                ds.PixelData = rng.integers(0, 4096, size=(size, size), dtype=np.uint16).tobytes()
+                path = osp.join(study_dir, f"series-{j}", f"IM-{k:04d}.dcm")
+                _write_dataset(path, ds, MR_IMAGE_STORAGE)
+                cohort.dicoms.append(path)
+
+        series_uid = f"{study_uid}.0"
+        for k in annotated:
+            sop_uid = f"{series_uid}.{k}"
+            rois = [(name, synthetic_polygon(*rng.uniform(0.4, 0.6, size=2) * size, size * (0.3 - 0.15 * r),
+                                             num_points=len(template.points)))
+                    for r, name in enumerate(SYNTHETIC_ROI_NAMES)]
+            cohort.num_rois += len(rois)
+            cohort.num_points += sum(len(points) for _, points in rois)
+
+            # OsiriX saves every ROI as an OsirixSR of its own
+            for name, points in rois:
+                n = len(cohort.osirix_sr) - sr_start
+                ref = Dataset()
+                ref.ReferencedSOPClassUID = MR_IMAGE_STORAGE
+                ref.ReferencedSOPInstanceUID = sop_uid
+                item = Dataset()
+                item.RelationshipType = "CONTAINS"
+                item.ValueType = "IMAGE"
+                item.ReferencedSOPSequence = [ref]
+                ds = Dataset()
+                ds.PatientName = f"Synthetic^{i}"
+                ds.PatientID = f"synthetic-{i}"
+                ds.Modality = "SR"
+                ds.StudyInstanceUID = study_uid
+                ds.SeriesInstanceUID = f"{study_uid}.999"
+                ds.SOPInstanceUID = f"{study_uid}.999.{n}"
+                ds.SeriesDescription = "OsiriX ROI SR"
+                ds.InstanceNumber = n
+                ds.ValueType = "CONTAINER"
+                ds.ContentSequence = [item]
+                ds.EncapsulatedDocument = osirix_document(template, name, points, study_uid)
+                path = osp.join(study_dir, "sr", f"IM-{n:04d}.dcm")
+                _write_dataset(path, ds, BASIC_TEXT_SR_STORAGE)
+                cohort.osirix_sr.append(path)
+
+            json_rois = []
+            for name, points in rois:
+                values = np.concatenate([points, np.full((len(points), 1), 3. * k), points], axis=1)
+                csv_lines.append(",".join([str(k), name, sop_uid, study_uid, series_uid, str(len(points))] +
+                                          [repr(v) for v in values.flatten().tolist()]))
+                json_rois.append(dict(Name=name, SOPInstanceUID=sop_uid, StudyInstanceUID=study_uid,
+                                      SeriesInstanceUID=series_uid,
+                                      Point_px=[f"({x}, {y})" for x, y in points.tolist()]))
+            json_images.append(dict(ImageIndex=int(k), ImageHeight=size, ImageWidth=size,
+                                    ImageTotalNum=num_slices, ROIs=json_rois))
+
+        if len(csv_lines) > 0:
+            path = osp.join(study_dir, "rois.csv")
+            with open(path, "w") as f:
+                f.write("ImageNo,RoiName,SOPInstanceUID,StudyInstanceUID,SeriesInstanceUID,NumOfPoints,mmX,mmY,mmZ,pxX,pxY\n")
+                f.write("\n".join(csv_lines) + "\n")
+            cohort.csvs.append(path)
+            path = osp.join(study_dir, "rois.json")
+            with open(path, "w") as f:
+                json.dump(dict(Images=json_images), f)
+            cohort.jsons.append(path)
+    return cohort
+
+
+# stages timed by `bench_pipeline_stages`, in pipeline order
+PIPELINE_STAGES = ["walk", "scan", "grouping", "sr_parsing", "sr_parsing_plist", "csv_parsing", "json_parsing",
+                   "rasterization", "rt_build", "overlays", "nifti_export"]
+
+
+def _best_of(func, repeat):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_pipeline_stages(cohort, workdir, stages=PIPELINE_STAGES, repeat=3):
+    """
+    time every stage of the OsirixSR pipeline separately on a cohort written by `write_synthetic_cohort`,
+    the outputs of each stage are the inputs of the next one and files are written to `workdir`.
+    Returns stage -> dict(seconds, items, seconds_per_item) for the best of `repeat` runs,
+    a stage whose dependencies are missing is reported as dict(skipped=reason).
+    """
+    from walker import collect_inputs, DICOM, OSIRIX_SR
+    from dicom_utils import read_dicom_info, find_osirix_sr
+    from osirix_parser import OsirixSRParser, STRUCTURED
+    from parse_roi import parse_csv, load_json
+    from sparse_mask import SparseMask
+    from rtconvert import plan_study
+
+    state = dotdict()
+
+    def walk():
+        inputs = collect_inputs(cohort.root, [DICOM, OSIRIX_SR])
+        state.paths = sorted(inputs[DICOM] + inputs[OSIRIX_SR])
+        return len(state.paths)
+
+    def scan():
+        state.records = read_dicom_info(state.paths)
+        return len(state.records)
+
+    def grouping():
+        state.studies = [plan_study(dicoms) for dicoms in group_into_studies(state.records).values()]
+        return len(state.studies)
+
+    def sr_parsing():
+        # the default parser of rtconvert
+        parser = OsirixSRParser()
+        state.rois = {osx.fullpath: parser(osx) for osx in find_osirix_sr(state.records)}
+        return len(state.rois)
+
+    def sr_parsing_plist():
+        parser = OsirixSRParser(version=STRUCTURED)
+        return len([parser(osx) for osx in find_osirix_sr(state.records)])
+
+    def csv_parsing():
+        return sum(len(parse_csv(fn)) for fn in cohort.csvs)
+
+    def json_parsing():
+        return sum(len(load_json(fn).rois) for fn in cohort.jsons)
+
+    def rasterization():
+        # SeriesInstanceUID -> (slices in geometry order, name -> SparseMask)
+        state.series = dict()
+        for study in state.studies:
+            for series_uid, osirix_sr in study.osirix_sr.items():
+                geometry = study.geometry[series_uid]
+                series, z = geometry.slices, geometry.index
+                named3dmask = dict()
+                for osx in osirix_sr:
+                    for roi in state.rois[osx.fullpath]:
+                        if roi.name not in named3dmask:
+                            named3dmask[roi.name] = SparseMask(series[0].Rows, series[0].Columns, len(series))
+                        named3dmask[roi.name].fill_poly(z[osx.ReferencedSOPInstanceUID], roi.coords)
+                state.series[series_uid] = (series, named3dmask)
+        return sum(len(mask) for _, named3dmask in state.series.values() for mask in named3dmask.values())
+
+    def rt_build():
+        from rtstruct_utils import load_series_headers, create_rtstruct
+        state.series_data = dict()
+        for series_uid, (series, named3dmask) in state.series.items():
+            rtstruct = create_rtstruct(load_series_headers(series))
+            for name, mask in named3dmask.items():
+                rtstruct.add_roi(mask=mask.to_dense(), name=name)
+            rtstruct.save(osp.join(workdir, f"{series_uid}_rtstruct.dcm"))
+            state.series_data[series_uid] = rtstruct.series_data
+        return len(state.series)
+
+    def overlays():
+        from overlay import OverlayWriter
+        with OverlayWriter() as writer:
+            for series_uid, (series, named3dmask) in state.series.items():
+                writer.write_series([s.fullpath for s in series],
+                                    [osp.join(workdir, f"{series_uid}-{z}") for z in range(len(series))],
+                                    named3dmask)
+        return sum(len(mask) for _, named3dmask in state.series.values() for mask in named3dmask.values())
+
+    def nifti_export():
+        from export import export_label_map
+        for series_uid, (series, named3dmask) in state.series.items():
+            export_label_map(named3dmask, state.series_data[series_uid], osp.join(workdir, f"{series_uid}_labels"))
+        return len(state.series)
+
+    funcs = dict(walk=walk, scan=scan, grouping=grouping, sr_parsing=sr_parsing, sr_parsing_plist=sr_parsing_plist,
+                 csv_parsing=csv_parsing, json_parsing=json_parsing, rasterization=rasterization, rt_build=rt_build,
+                 overlays=overlays, nifti_export=nifti_export)
+    # stages the requested ones depend on are run (but not reported) to produce their inputs
+    last = max(PIPELINE_STAGES.index(stage) for stage in stages)
+    results = dict()
+    for stage in PIPELINE_STAGES[:last + 1]:
+        if stage in ("sr_parsing_plist", "csv_parsing", "json_parsing") and stage not in stages:
+            continue
+        try:
+            seconds, items = _best_of(funcs[stage], repeat if stage in stages else 1)
+        except ImportError as e:
+            warn(f"Stage {stage} skipped: {e}")
+            results[stage] = dict(skipped=str(e))
+            continue
+        if stage in stages:
+            results[stage] = dict(seconds=seconds, items=items, seconds_per_item=seconds / max(items, 1))
+    return results
+
+
+def environment():
+    """
+    versions and hardware the benchmarks ran on
+    """
+    return dict(python=platform.python_version(), platform=platform.platform(),
+                machine=platform.machine(), cpu_count=os.cpu_count(), numpy=np.__version__)
+
+
+def compare_stages(results, baseline, tolerance):
+    """
+    problems of stages that are more than `tolerance` times slower than in the `baseline` results
+    """
+    problems = []
+    for stage, r in results.items():
+        b = baseline.get(stage, {})
+        if "seconds" not in r or "seconds" not in b:
+            continue
+        if r["seconds_per_item"] > tolerance * b["seconds_per_item"]:
+            problems.append(f"Stage {stage} regressed: {b['seconds_per_item']:.2e}s -> {r['seconds_per_item']:.2e}s per item.")
+    return problems
+
+
+# third-party modules that are slow to import
+HEAVY_MODULES = ["numpy", "cv2", "pydicom", "rt_utils", "nibabel", "vlkit", "tqdm"]
+
+# heavy modules each entry point is allowed to import before running a command
+IMPORT_ALLOWED = dict(
+    cli=[],
+    rtconvert=["numpy", "cv2", "pydicom", "rt_utils", "tqdm"],
+    csv2rt=["numpy", "cv2", "pydicom", "rt_utils", "tqdm"],
+    roi2rt=["numpy", "cv2", "pydicom", "rt_utils", "tqdm"],
+    rt2NIfTI=["numpy", "cv2", "pydicom", "rt_utils", "tqdm", "nibabel"],
+    batch_convert=["numpy", "cv2", "pydicom", "rt_utils", "tqdm"],
+)
+
+
+def bench_import_time(modules=IMPORT_ALLOWED, repeat=3):
+    """
+    import every entry point in a fresh interpreter, record the import time
+    and the heavy modules it pulls in.
+    """
+    code = ("import sys, time, json; start = time.perf_counter(); import {}; "
+            "print(json.dumps([time.perf_counter() - start, [m for m in {} if m in sys.modules]]))")
+    results = []
+    for module in modules:
+        best, loaded = float("inf"), None
+        for _ in range(repeat):
+            # `-c` only puts the working directory on sys.path
+            out = subprocess.run([sys.executable, "-c", code.format(module, HEAVY_MODULES)],
+                                 capture_output=True, text=True, check=True,
+                                 cwd=osp.dirname(osp.abspath(__file__))).stdout
+            seconds, loaded = json.loads(out)
+            best = min(best, seconds)
+        results.append(dict(module=module, seconds=best, heavy_modules=loaded))
+    return results
+
+
+def check_import_time(results, budget):
+    """
+    problems of `bench_import_time` results: unexpected heavy imports and `cli` over the time `budget`
+    """
+    problems = []
+    for r in results:
+        unexpected = sorted(set(r["heavy_modules"]) - set(IMPORT_ALLOWED[r["module"]]))
+        if len(unexpected) > 0:
+            problems.append(f"{r['module']} imports {', '.join(unexpected)}.")
+        if r["module"] == "cli" and r["seconds"] > budget:
+            problems.append(f"cli takes {r['seconds']:.3f}s to import, budget is {budget:.3f}s.")
+    return problems
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="""Benchmarks of the conversion pipelines, results are printed as json.
+        Every stage of the pipeline is timed on a synthetic cohort of
+        --studies x --series x --slices dicoms, which is written to --cohort-dir or a temporary directory.
+        """
+        )
+    parser.add_argument('--check', action='store_true',
+                        help='exit with non-zero status if the time per study grows with the cohort size (--study-planning) or imports exceed their budget')
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='allowed ratio between the largest and smallest time per study')
+    parser.add_argument('--import-budget', type=float, default=0.05,
+                        help='maximum seconds to import the cli entry point')
+    parser.add_argument('--studies', type=int, default=2,
+                        help='number of studies of the synthetic cohort')
+    parser.add_argument('--series', type=int, default=2,
+                        help='number of image series per study')
+    parser.add_argument('--slices', type=int, default=16,
+                        help='number of slices per series')
+    parser.add_argument('--sr', type=int, default=4,
+                        help='number of annotated slices per study, each ROI on them is an OsirixSR')
+    parser.add_argument('--size', type=int, default=128,
+                        help='rows and columns of the synthetic slices')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='every stage is run this many times and the best time is kept')
+    parser.add_argument('--stages', type=str, nargs='+', default=PIPELINE_STAGES, choices=PIPELINE_STAGES,
+                        help='pipeline stages to time')
+    parser.add_argument('--study-planning', action='store_true',
+                        help='also time planning the jobs of cohorts of 8 to 64 studies, with --check it has to scale linearly')
+    parser.add_argument('--cohort-dir', type=str, default=None,
+                        help='write the synthetic cohort to this directory and keep it')
+    parser.add_argument('--output', type=str, default=None,
+                        help='also save the results to this json file')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='results of an earlier run, with --check stages more than --tolerance times slower fail')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        cohort_dir = args.cohort_dir or osp.join(workdir, "cohort")
+        start = time.perf_counter()
+        cohort = write_synthetic_cohort(cohort_dir, num_studies=args.studies, num_series=args.series,
+                                        num_slices=args.slices, num_sr=args.sr, size=args.size)
+        cohort_seconds = time.perf_counter() - start
+        os.makedirs(osp.join(workdir, "outputs"))
+        pipeline = bench_pipeline_stages(cohort, osp.join(workdir, "outputs"), stages=args.stages, repeat=args.repeat)
+        study_planning = bench_study_planning(osp.join(workdir, "planning")) if args.study_planning else None
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    results = dict(
+        environment=environment(),
+        cohort=dict(studies=args.studies, series=args.series, slices=args.slices, sr=args.sr, size=args.size,
+                    dicoms=len(cohort.dicoms) + len(cohort.osirix_sr), rois=cohort.num_rois,
+                    points=cohort.num_points, seconds=cohort_seconds),
+        pipeline=pipeline,
+        study_planning=study_planning,
+        json_points=bench_json_points(),
+        import_time=bench_import_time())
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.check:
+        problems = check_import_time(results["import_time"], args.import_budget)
+        if args.baseline is not None:
+            with open(args.baseline, 'r') as f:
+                problems.extend(compare_stages(pipeline, json.load(f).get("pipeline", {}), args.tolerance))
+        if study_planning is not None:
+            per_study = [r["seconds_per_study"] for r in study_planning]
+            if per_study[-1] > args.tolerance * per_study[0]:
+                problems.append(f"Study planning does not scale linearly: {per_study[0]:.2e}s -> {per_study[-1]:.2e}s per study.")
+        for problem in problems:
+            print(problem)
+        if len(problems) > 0:
+            sys.exit(1)
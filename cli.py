@@ -0,0 +1,36 @@
+import argparse, importlib
+
+
+# subcommand -> (module, description), a module is only imported when its subcommand runs
+COMMANDS = dict(
+    osirix=("rtconvert", "convert OsirixSR annotations to dicom-rt structure sets"),
+    csv=("csv2rt", "convert csv ROI exports to dicom-rt structure sets"),
+    json=("roi2rt", "convert json ROI exports to dicom-rt structure sets"),
+    nifti=("rt2NIfTI", "export dicom-rt structure sets and their series to NIfTI"),
+    batch=("batch_convert", "convert the csv annotations of many cases, resumable"),
+)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="cli",
+        usage="cli {" + ",".join(COMMANDS) + "} ...",
+        description="Convert annotations to dicom-rt structure sets and export them. "
+                    "Run `cli <command> --help` for the options of a command.",
+        epilog="commands:\n" + "\n".join([f"  {name:<8} {desc}" for name, (_, desc) in COMMANDS.items()]),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+    parser.add_argument('command', choices=list(COMMANDS), metavar='command')
+    parser.add_argument('args', nargs=argparse.REMAINDER,
+                        help='options of the command')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    module = importlib.import_module(COMMANDS[args.command][0])
+    return module.main(args.args)
+
+
+if __name__ == "__main__":
+    main()
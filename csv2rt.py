@@ -1,142 +1,263 @@
 import os, shutil, argparse
-from glob import glob
 import os.path as osp
 from warnings import warn
-import os, sys, json, shutil, pathlib, pydicom, hashlib
-import numpy as np
-import cv2
-from vlkit import normalize
-from rt_utils import RTStructBuilder
+from rtstruct_utils import load_series_headers, create_rtstruct
 from pydicom import dcmread
 from parse_roi import parse_csv
-from vlkit.dicom import (
-    group_dicoms_into_series,
-    group_dicoms_into_studies,
-    build_sop_instance_uid_lookup_table
-)
-from dicom_utils import read_dicom_info
-from vlkit import str2color
+from sparse_mask import SparseMask
+from geometry import SeriesGeometry
+from dicom_utils import dotdict, read_dicom_info, group_into_series, group_into_studies
+from dicom_index import open_dicom_index
+from scheduler import run_jobs, warn_failed_jobs
+from staging import Stager, STAGE_METHODS
+from export import export_label_map, EXPORT_FORMATS
+from walker import collect_inputs, add_walk_arguments, DICOM, ROI_CSV
+from tracing import Tracer, add_trace_arguments, tracer_from_args, header_bytes
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
-        prog="rtconvert",
-        usage="rtconvert path/to/dicoms/",
-        description="""Convert annotations to dicom-rt structure set.
-        It will search all suported annotations (currently support OsirixSR)
-        and corresponding dicom files, and convert annotations into dicom-rt structure.
+        prog="csv2rt",
+        usage="csv2rt path/to/dicoms/ --save-to path/to/output/",
+        description="""Convert csv ROI exports to dicom-rt structure sets.
+        It will search all csv ROIs and the dicom series they are drawn on,
+        the series, masks and overlays are written to the --save-to directory.
         """
         )
     parser.add_argument('dicom')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes used to read dicom meta data and convert series')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='maximum number of series being converted at the same time (default: 2 x workers)')
+    parser.add_argument('--ordered', action='store_true',
+                        help='report converted series in a deterministic order')
+    parser.add_argument('--index', action='store_true',
+                        help='keep a persistent meta data index in the data directory and only re-read changed files')
     parser.add_argument('--save-to', type=str, default=None)
-    
-    args =  parser.parse_args()
+    parser.add_argument('--polygon', action='store_true',
+                        help='write the csv points as contours instead of rasterizing and re-contouring them')
+    parser.add_argument('--no-visualization', action='store_true',
+                        help='do not write masks and overlays of the annotated slices')
+    parser.add_argument('--overlay-every', type=int, default=1,
+                        help='write the overlay of every N-th annotated slice, 0 to write no overlay')
+    parser.add_argument('--verify-pixels', action='store_true',
+                        help='decode the pixel data of every slice to check its dimension, slow on compressed series')
+    parser.add_argument('--stage', type=str, default='auto', choices=STAGE_METHODS,
+                        help='how the series are placed into the target directory, "auto" hardlinks or reflinks and falls back to copy')
+    add_walk_arguments(parser)
+    parser.add_argument('--export', type=str, default=None, choices=EXPORT_FORMATS,
+                        help='also save the ROIs of every series as a label map next to its structure set')
+    add_trace_arguments(parser)
+
+    args =  parser.parse_args(argv)
     return args
 
-def process(data_dir):
+def convert_series(job):
+    """
+    convert the csv ROIs of one series into a dicom-rt structure set,
+    the series and the visualizations are written to `job.save_to`.
+    Returns the path of the saved structure set.
+    """
+    with job.tracer.span("series", study=job.StudyInstanceUID, series=job.SeriesInstanceUID):
+        return _convert_series(job, job.tracer)
+
+
+def _convert_series(job, tracer):
+    series = job.geometry.slices
+    rois = job.rois
+    unique_sop_instance_uids = set([s.SOPInstanceUID for s in series])
+    if len(unique_sop_instance_uids) != len(series):
+        raise RuntimeError(f"Duplicate SOPInstanceUID found in series {job.series_prefix}.")
+
+    series_dir = osp.join(job.save_to, osp.relpath(job.series_prefix, job.data_dir))
+    try:
+        # stage series to target, each slice is linked or copied once
+        with tracer.span("staging", series=job.SeriesInstanceUID, method=job.stage) as span:
+            stager = Stager(job.stage)
+            for s in series:
+                stager.stage(s.fullpath, osp.join(job.save_to, osp.relpath(s.fullpath, start=job.data_dir)))
+            span.files += len(series)
+        # dimensions are checked on the Rows/Columns read at scan time,
+        # decoding the pixels of every slice is an opt-in integrity check
+        h, w = series[0].Rows, series[0].Columns
+        with tracer.span("check_dimensions", series=job.SeriesInstanceUID) as span:
+            for s in series:
+                assert s.Rows is not None and (s.Rows, s.Columns) == (h, w), f"Bad dimension: {s.fullpath}."
+                if job.verify_pixels:
+                    assert dcmread(s.fullpath).pixel_array.shape == (h, w), f"Bad pixel data: {s.fullpath}."
+                    span.pixel_decodes += 1
+
+        roi_names = sorted(set([roi["RoiName"] for roi in rois]))
+        with tracer.span("load_headers", series=job.SeriesInstanceUID) as span:
+            series_data = load_series_headers(series)
+            span.files += len(series)
+            span.bytes_read += header_bytes(series)
+        rtstruct = create_rtstruct(series_data)
+
+        # in polygon mode the csv points go straight into the structure set,
+        # masks are only rasterized for the visualization
+        if job.polygon:
+            from rt_utils.utils import Polygon2D
+        named3dmask = dict()
+        named_polygons = dict()
+        with tracer.span("rasterization", series=job.SeriesInstanceUID) as span:
+            for roi_name in roi_names:
+                if job.visualize or not job.polygon or job.export is not None:
+                    named3dmask[roi_name] = SparseMask(h, w, len(series))
+                if job.polygon:
+                    named_polygons[roi_name] = [Polygon2D(coords=[], h=h, w=w)] * len(series)
+                for roi in rois:
+                    if roi["RoiName"] == roi_name:
+                        # ImageNo follows the slice order of the exporting viewer, slices are found by their SOPInstanceUID
+                        z = job.geometry.index.get(roi["SOPInstanceUID"])
+                        assert z is not None, f"{roi['SOPInstanceUID']} (ImageNo {roi['ImageNo']}) not found in {job.series_prefix}."
+                        span.rois += 1
+                        span.points += roi["num_points"]
+                        # generate masks
+                        if roi_name in named3dmask:
+                            named3dmask[roi_name].fill_poly(z, roi["points_px"])
+                        if job.polygon:
+                            if len(named_polygons[roi_name][z].coords) > 0:
+                                warn(f"Multiple \"{roi_name}\" ROIs on slice #{z} of {job.series_prefix}, only the last one is kept.")
+                            named_polygons[roi_name][z] = Polygon2D(coords=roi["points_px"].flatten().tolist(), h=h, w=w)
+
+        if job.visualize:
+            from overlay import OverlayWriter
+            with tracer.span("overlays", series=job.SeriesInstanceUID) as span:
+                with OverlayWriter(overlay_every=job.overlay_every) as writer:
+                    span.pixel_decodes += writer.write_series(
+                        [s.fullpath for s in series],
+                        [osp.join(job.save_to, osp.relpath(s.fullpath, start=job.data_dir)) for s in series],
+                        named3dmask)
+        with tracer.span("rt_build", series=job.SeriesInstanceUID) as span:
+            for roi_name in roi_names:
+                if job.polygon:
+                    rtstruct.add_roi(polygon=named_polygons[roi_name], name=roi_name)
+                else:
+                    rtstruct.add_roi(mask=named3dmask[roi_name].to_dense(), name=roi_name)
+            span.rois += len(roi_names)
+        save_path = osp.join(job.study_prefix, job.SeriesInstanceUID+"_rtstruct.dcm")
+        with tracer.span("rt_save", series=job.SeriesInstanceUID) as span:
+            rtstruct.save(save_path)
+            span.files += 1
+            span.bytes_written += osp.getsize(save_path)
+        if job.export is not None:
+            with tracer.span("export", series=job.SeriesInstanceUID, format=job.export) as span:
+                export_path = export_label_map(named3dmask, rtstruct.series_data, save_path[:-len('_rtstruct.dcm')] + '_labels', fmt=job.export)
+                span.files += 1
+                span.bytes_written += osp.getsize(export_path)
+    except Exception as e:
+        shutil.rmtree(series_dir, ignore_errors=True)
+        raise RuntimeError(f"Failed to process {job.series_prefix}. {e}")
+    return save_path
+
+
+def process(data_dir, save_to, num_workers=1, use_index=False, max_in_flight=None, ordered=False,
+            polygon=False, visualize=True, overlay_every=1, verify_pixels=False, stage="auto", export=None,
+            include=None, exclude=None, max_depth=None, tracer=None):
+    """
+    convert all csv ROIs in `data_dir`, returns the (series, reason) of series failed to convert
+    """
+    tracer = Tracer() if tracer is None else tracer
     print(f"Searching dicom files in {data_dir}, this may take a while.")
-    dicoms = glob(f"{data_dir}/**/*.dcm", recursive=True)
+    with tracer.span("walk") as span:
+        inputs = collect_inputs(data_dir, [DICOM, ROI_CSV], include=include, exclude=exclude, max_depth=max_depth)
+        dicoms = inputs[DICOM]
+        span.files += len(dicoms) + len(inputs[ROI_CSV])
     if len(dicoms) == 0:
         raise RuntimeError(f"no dicom file found in {data_dir}")
     else:
         print(f"Found {len(dicoms)} dicom files, gathering their meta data.")
-    dicom_info = read_dicom_info(dicoms)
-    studies = group_dicoms_into_studies(dicom_info)
+    with tracer.span("scan", index=use_index) as span:
+        if use_index:
+            index = open_dicom_index(data_dir, dicoms, num_workers=num_workers)
+            studies = index.studies()
+        else:
+            dicom_info = read_dicom_info(dicoms, num_workers=num_workers)
+            studies = group_into_studies(dicom_info)
+            span.files += len(dicom_info)
+            span.bytes_read += header_bytes(dicom_info)
 
-    # find all json ROIs
-    csv_files = glob(f"{data_dir}/**/*.csv", recursive=True)
+    # find all csv ROIs
+    csv_files = inputs[ROI_CSV]
     if len(csv_files) == 0:
         warn(f"No csv found in {data_dir}.")
-        return
-    print(f"Found {len(csv_files)} jsons in {data_dir}.")
+        return []
+    print(f"Found {len(csv_files)} csvs in {data_dir}.")
     SeriesInstanceUID2csv = dict()
     for csv in csv_files:
-        rois = parse_csv(csv)
+        with tracer.span("csv_parsing", csv=csv) as span:
+            rois = parse_csv(csv)
+            span.files += 1
+            span.bytes_read += osp.getsize(csv)
+            span.rois += len(rois)
+            span.points += sum(roi["num_points"] for roi in rois)
         assert len(rois) > 0, f"No ROI found in {csv}."
         SeriesInstanceUID2csv[
             rois[0]["SeriesInstanceUID"]
         ] = dict(csv=csv, rois=rois)
 
+    jobs = []
     for study_idx, (study_instance_uid, study_dicom_info) in enumerate(studies.items()):
         dicom_paths = [dcm.fullpath for dcm in study_dicom_info]
         study_prefix = osp.commonpath(dicom_paths)
         print(f"Processing study {study_idx}: {study_prefix}.")
 
-        SOPInstanceUID_lookup_table = build_sop_instance_uid_lookup_table(study_dicom_info)
-        series_instance_uid2series = group_dicoms_into_series(study_dicom_info, remove_duplicates=True)
+        with tracer.span("group_series", study=study_instance_uid):
+            if use_index:
+                series_instance_uid2series = index.series(study_instance_uid)
+            else:
+                series_instance_uid2series = group_into_series(study_dicom_info)
 
         for series_idx, (SeriesInstanceUID, series) in enumerate(series_instance_uid2series.items()):
-            unique_sop_instance_uids = set([s.SOPInstanceUID for s in series])
             series_perfix = osp.commonpath([s.fullpath for s in series])
-            if len(unique_sop_instance_uids) != len(series):
-                raise RuntimeError(f"Duplicate SOPInstanceUID found in series {series_perfix}.")
-            
             if SeriesInstanceUID not in SeriesInstanceUID2csv:
                 warn(f"No ROIs found for {series_perfix} id={SeriesInstanceUID}.")
                 continue
             csv = SeriesInstanceUID2csv[SeriesInstanceUID]
-            series = sorted(series, key=lambda x:x.fullpath)
-
             print(f"Series {series_perfix} ({len(series)}  dicoms) matched with {csv['csv']}.")
+            jobs.append(dotdict(
+                SeriesInstanceUID=SeriesInstanceUID,
+                StudyInstanceUID=study_instance_uid,
+                geometry=SeriesGeometry(series),
+                series_prefix=series_perfix,
+                study_prefix=study_prefix,
+                rois=csv['rois'],
+                data_dir=data_dir,
+                save_to=save_to,
+                polygon=polygon,
+                visualize=visualize,
+                overlay_every=overlay_every,
+                verify_pixels=verify_pixels,
+                stage=stage,
+                export=export,
+                tracer=tracer))
 
-            tmp_series_dir = osp.join(args.save_to, osp.relpath(series_perfix, data_dir))
-            try:
-                # copy series to target
-                os.makedirs(tmp_series_dir, exist_ok=True)
-                for s in series:
-                    shutil.copy(s.fullpath, tmp_series_dir)
-                #
-                h, w = dcmread(series[0].fullpath).pixel_array.shape
-                for s in series:
-                    assert dcmread(s.fullpath).pixel_array.shape == (h, w), f"Bad dimension: {s.fullpath}."
-
-                named3dmask = dict()
-                roi_names = set([roi["RoiName"] for roi in rois])
-                for name in roi_names:
-                    named3dmask[name] = np.zeros((h, w, len(series)), dtype=bool)
-
-                rtstruct = RTStructBuilder.create_new(dicom_series_path=tmp_series_dir)
-
-                for roi_name in roi_names:
-                    for roi in rois:
-                        if roi["RoiName"] == roi_name:
-                            # sanity check
-                            ImageNo = int(roi["ImageNo"])
-                            s = series[ImageNo]
-                            assert roi["SOPInstanceUID"] == s.SOPInstanceUID, f"{roi['SOPInstanceUID']} v.s. {s.SOPInstanceUID}."
-                            # generate masks
-                            mask1 = named3dmask[roi_name][:, :, ImageNo].copy().astype(np.uint8)
-                            cv2.fillPoly(mask1, [roi["points_px"].astype(np.int32)], color=1)
-                            named3dmask[roi_name][:, :, int(roi["ImageNo"])] = mask1.astype(bool)
-
-                for i, s in enumerate(series):
-                    relpath = osp.relpath(s.fullpath, start=data_dir)
-                    save_to = osp.join(args.save_to, relpath)
-                    os.makedirs(osp.dirname(save_to), exist_ok=True)
-                    shutil.copy(s.fullpath, save_to)
-                    mask1 = named3dmask[roi_name][:, :, i]
-                    if mask1.sum() > 0:
-                        np.save(f"{save_to}.{roi_name}.npy", mask1)
-                        cv2.imwrite(f"{save_to}.{roi_name}_mask.png", mask1 * 255)
-                        img = normalize(dcmread(s.fullpath).pixel_array, 0, 1)
-                        img = np.stack([img] * 3, axis=-1)
-                        color = np.ones((h, w, 3)) * np.array(str2color(roi_name))
-                        alpha = 0.3
-                        overlay = color * mask1[:, :, None] * alpha + img * (1 - alpha)
-                        overlay = normalize(overlay, 0, 255).astype(np.uint8)
-                        cv2.imwrite(f"{save_to}.{roi_name}.overlay.jpg", overlay)
-                        # print(f"Writing visualization to {save_to}. [{i+1}/{len(series)}].")
-                rtstruct.add_roi(mask=named3dmask[roi_name], name=roi_name)
-                rtstruct.save(osp.join(study_prefix, SeriesInstanceUID+"_rtstruct.dcm"))
-            except Exception as e:
-                warn(f"Failed to process {series_perfix}. {e}")
-                shutil.rmtree(tmp_series_dir)
+    failures = []
+    for _, job, save_path, error in run_jobs(convert_series, jobs, num_workers=num_workers,
+                                             max_in_flight=max_in_flight, ordered=ordered):
+        if error is not None:
+            failures.append((job.series_prefix, error))
+        else:
+            print(f"Saved structure set to \"{save_path}\"")
+    warn_failed_jobs(failures, len(jobs))
+    return failures
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
     if not osp.isdir(args.dicom):
         raise RuntimeError(f'{args.dicom} is not a directory')
     if args.dicom == '/':
         warn("You are searching dicoms in the root directory, this might be EXTREMELY time-consuming. Consider providing a more specific sub-directory.")
-    process(args.dicom)
+    tracer = tracer_from_args(args)
+    process(args.dicom, args.save_to, num_workers=args.workers, use_index=args.index,
+            max_in_flight=args.max_in_flight, ordered=args.ordered,
+            polygon=args.polygon, visualize=not args.no_visualization, overlay_every=args.overlay_every,
+            verify_pixels=args.verify_pixels, stage=args.stage, export=args.export,
+            include=args.include, exclude=args.exclude, max_depth=args.max_depth, tracer=tracer)
+    tracer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+import os
+import os.path as osp
+import json
+import sqlite3
+import numpy as np
+from dicom_utils import dotdict, crawl_dicom_info, warn_invalid_dicoms
+
+
+# bump when the record layout changes, the index is rebuilt from scratch on mismatch
+SCHEMA_VERSION = 4
+
+# fields of the records produced by `dicom_utils.read_dicom_record`
+FIELDS = [
+    "fullpath",
+    "SeriesDescription",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "StudyInstanceUID",
+    "InstanceNumber",
+    "SliceLocation",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "Rows",
+    "Columns",
+    "is_osirix_sr",
+    "ReferencedSOPInstanceUID",
+    "EncapsulatedDocument",
+    "PixelDataOffset",
+    "PixelDataLength",
+]
+
+# fields stored as json text
+JSON_FIELDS = {"ImagePositionPatient", "ImageOrientationPatient"}
+
+DEFAULT_INDEX_NAME = ".dicom_index.sqlite"
+
+
+def _encode(field, value):
+    if field in JSON_FIELDS:
+        return None if value is None else json.dumps(np.asarray(value).tolist())
+    if isinstance(value, (bool, np.bool_)):
+        return int(value)
+    return value
+
+
+def _decode(field, value):
+    if field in JSON_FIELDS:
+        return None if value is None else np.array(json.loads(value))
+    if field == "is_osirix_sr":
+        return bool(value)
+    return value
+
+
+class DicomIndex(object):
+    """
+    Persistent index of dicom meta data keyed by (path, mtime, size).
+    `update` only re-reads new or modified files and drops deleted ones,
+    studies and series are answered by indexed queries.
+    """
+    def __init__(self, db_path) -> None:
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self._create_tables()
+
+    @classmethod
+    def for_directory(cls, data_dir):
+        return cls(osp.join(data_dir, DEFAULT_INDEX_NAME))
+
+    def _create_tables(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.conn.execute("DROP TABLE IF EXISTS dicoms")
+            self.conn.execute("DROP TABLE IF EXISTS failures")
+        columns = ", ".join(["fullpath TEXT PRIMARY KEY", "mtime INTEGER", "size INTEGER"] + FIELDS[1:])
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS dicoms ({columns})")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS failures (fullpath TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, reason TEXT)")
+        for field in ["StudyInstanceUID", "SeriesInstanceUID", "SOPInstanceUID"]:
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{field} ON dicoms ({field})")
+        self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM dicoms").fetchone()[0]
+
+    def update(self, dicoms, num_workers=1):
+        """
+        synchronize the index with the list of files `dicoms`.
+        Returns the (path, reason) of all indexed files that are not valid dicoms.
+        """
+        stats = dict()
+        for d in dicoms:
+            st = os.stat(d)
+            stats[d] = (st.st_mtime_ns, st.st_size)
+
+        known = dict()
+        for table in ["dicoms", "failures"]:
+            for fullpath, mtime, size in self.conn.execute(f"SELECT fullpath, mtime, size FROM {table}"):
+                known[fullpath] = (table, (mtime, size))
+
+        deleted = [(p,) for p in known if p not in stats]
+        changed = [d for d in dicoms if d not in known or known[d][1] != stats[d]]
+        self.conn.executemany("DELETE FROM dicoms WHERE fullpath = ?", deleted + [(d,) for d in changed])
+        self.conn.executemany("DELETE FROM failures WHERE fullpath = ?", deleted + [(d,) for d in changed])
+
+        if len(changed) > 0:
+            print(f"Index {self.db_path}: {len(dicoms) - len(changed)} files up to date, re-reading {len(changed)}.")
+        results, errors = crawl_dicom_info(changed, num_workers=num_workers)
+        placeholders = ", ".join(["?"] * (len(FIELDS) + 2))
+        self.conn.executemany(
+            f"INSERT INTO dicoms (fullpath, mtime, size, {', '.join(FIELDS[1:])}) VALUES ({placeholders})",
+            [(r.fullpath, *stats[r.fullpath], *[_encode(f, r[f]) for f in FIELDS[1:]]) for r in results])
+        self.conn.executemany(
+            "INSERT INTO failures (fullpath, mtime, size, reason) VALUES (?, ?, ?, ?)",
+            [(path, *stats[path], reason) for path, reason in errors])
+        self.conn.commit()
+        return self.conn.execute("SELECT fullpath, reason FROM failures ORDER BY fullpath").fetchall()
+
+    def _query(self, where="", params=(), order_by="fullpath"):
+        rows = self.conn.execute(f"SELECT {', '.join(FIELDS)} FROM dicoms {where} ORDER BY {order_by}", params)
+        return [dotdict({f: _decode(f, v) for f, v in zip(FIELDS, row)}) for row in rows]
+
+    def records(self):
+        """
+        all records ordered by path
+        """
+        return self._query()
+
+    def studies(self):
+        """
+        same as `dicom_utils.group_into_studies` over all records
+        """
+        studies = dict()
+        for r in self._query(order_by="StudyInstanceUID, fullpath"):
+            studies.setdefault(r.StudyInstanceUID, []).append(r)
+        return studies
+
+    def series(self, StudyInstanceUID=None):
+        """
+        same as `dicom_utils.group_into_series`, optionally restricted to one study:
+        records grouped by SeriesInstanceUID, sorted by path and without duplicated SOPInstanceUID
+        """
+        if StudyInstanceUID is None:
+            records = self._query(order_by="SeriesInstanceUID, fullpath")
+        else:
+            records = self._query("WHERE StudyInstanceUID = ?", (StudyInstanceUID,), order_by="SeriesInstanceUID, fullpath")
+        series = dict()
+        sop_uids = set()
+        for r in records:
+            if (r.SeriesInstanceUID, r.SOPInstanceUID) in sop_uids:
+                continue
+            sop_uids.add((r.SeriesInstanceUID, r.SOPInstanceUID))
+            series.setdefault(r.SeriesInstanceUID, []).append(r)
+        return series
+
+
+def open_dicom_index(data_dir, dicoms, num_workers=1):
+    """
+    open the `DicomIndex` stored in `data_dir` and bring it up to date with `dicoms`
+    """
+    index = DicomIndex.for_directory(data_dir)
+    errors = index.update(dicoms, num_workers=num_workers)
+    warn_invalid_dicoms(errors, len(dicoms))
+    return index
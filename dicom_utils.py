@@ -1,11 +1,11 @@
 import pydicom
 import numpy as np
+import os, functools
 import os.path as osp
 import pathlib
-from glob import glob
 import logging
 from warnings import warn
-from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
 class dotdict(dict):
@@ -17,9 +17,11 @@ class dotdict(dict):
 
 def get_logger(log_file):
     logger = logging.getLogger("RTConvert")
+    if len(logger.handlers) > 0:
+        return logger
     stream_handler = logging.StreamHandler()
-    handlers = [stream_handler]
     file_handler = logging.FileHandler(log_file, 'w')
+    handlers = [stream_handler, file_handler]
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     for handler in handlers:
             handler.setFormatter(formatter)
@@ -29,19 +31,54 @@ def get_logger(log_file):
     return logger
 
 
+@functools.lru_cache(maxsize=256)
+def _dcmread_cached(fullpath, mtime_ns):
+    return pydicom.dcmread(fullpath)
+
+
+def dcmread_cached(fullpath):
+    """
+    `pydicom.dcmread` with a bounded LRU cache keyed by path and modification time
+    """
+    return _dcmread_cached(fullpath, os.stat(fullpath).st_mtime_ns)
+
+
+def _get_reference_uid(ds):
+    return ds.ContentSequence[0].ReferencedSOPSequence[0].ReferencedSOPInstanceUID
+
+
 def is_osirix_sr(ds):
-    return hasattr(pydicom.dcmread(ds.fullpath), "EncapsulatedDocument")
+    if ds.is_osirix_sr is not None:
+        return ds.is_osirix_sr
+    return hasattr(dcmread_cached(ds.fullpath), "EncapsulatedDocument")
 
 
 def osirix_get_reference_uid(ds):
+    """
+    SOPInstanceUID of the image an OsirixSR refers to.
+    Uses the value captured by `read_dicom_record` and only reads the file for records without it.
+    """
+    if "ReferencedSOPInstanceUID" in ds:
+        ref = ds.ReferencedSOPInstanceUID
+        if ref is None:
+            print(f"Cannot read referred dicom of {ds.fullpath}")
+        return ref
     try:
-        ref = pydicom.dcmread(ds.fullpath).ContentSequence[0].ReferencedSOPSequence[0].ReferencedSOPInstanceUID
+        ref = _get_reference_uid(dcmread_cached(ds.fullpath))
     except Exception as e:
         ref = None
         print(f"Cannot read referred dicom: {e}")
     return ref
 
 
+def osirix_get_document(ds):
+    """
+    the EncapsulatedDocument (bytes) of an OsirixSR, see `osirix_get_reference_uid`
+    """
+    if ds.EncapsulatedDocument is not None:
+        return ds.EncapsulatedDocument
+    return dcmread_cached(ds.fullpath).EncapsulatedDocument
+
 
 def get_common_prefix(paths):
     shortest = 0
@@ -56,35 +93,164 @@ def get_common_prefix(paths):
             return path
 
 
-def read_dicom_info(input):
+# tags needed to build the meta data record of a dicom, everything else is skipped in header-only mode
+HEADER_TAGS = [
+    "SeriesDescription",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "StudyInstanceUID",
+    "InstanceNumber",
+    "SliceLocation",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "Rows",
+    "Columns",
+    "EncapsulatedDocument",
+    "ContentSequence",
+]
+
+PIXEL_DATA_TAGS = (0x7FE00008, 0x7FE00009, 0x7FE00010)
+
+DEFLATED_TRANSFER_SYNTAX = "1.2.840.10008.1.2.1.99"
+
+
+def read_dicom_header(fullpath, tags=HEADER_TAGS):
+    """
+    read the header of a dicom file without loading its pixel data.
+    Only `tags` (keywords) are parsed, all other elements are skipped without reading their values,
+    `tags=None` parses all elements before the pixel data.
+    Returns the dataset and the (offset, length) in bytes of the pixel data value,
+    which are None if the file has no pixel data.
+    """
+    location = [None, None]
+    with open(fullpath, 'rb') as fp:
+        def stop_when(tag, vr, length):
+            if tag in PIXEL_DATA_TAGS:
+                # called right before reading the value, so fp points to the value
+                location[0], location[1] = fp.tell(), length
+                return True
+            return False
+        ds = pydicom.filereader.read_partial(
+            fp, stop_when=stop_when,
+            specific_tags=None if tags is None else [pydicom.datadict.tag_for_keyword(k) for k in tags])
+        if location[0] is not None and location[1] == 0xFFFFFFFF:
+            # undefined length (encapsulated) pixel data runs till the end of the file
+            location[1] = osp.getsize(fullpath) - location[0]
+    file_meta = getattr(ds, "file_meta", None)
+    if file_meta is not None and file_meta.get("TransferSyntaxUID") == DEFLATED_TRANSFER_SYNTAX:
+        # offsets refer to the inflated stream and cannot be used to seek in the file
+        location = [None, None]
+    return ds, location[0], location[1]
+
+
+def read_dicom_record(fullpath, header_only=True):
+    """
+    build the meta data record (a `dotdict`) of a single dicom file.
+    If `header_only`, the file is read up to the pixel data and only `HEADER_TAGS` are parsed,
+    the byte offset and length of the pixel data are recorded as `PixelDataOffset` and `PixelDataLength`.
+    For OsirixSR the referred SOPInstanceUID and the EncapsulatedDocument are captured as well,
+    so that the file does not need to be read again.
+    """
+    PixelDataOffset = PixelDataLength = None
+    if header_only:
+        ds, PixelDataOffset, PixelDataLength = read_dicom_header(fullpath)
+    else:
+        ds = pydicom.dcmread(fullpath)
+    InstanceNumber = int(ds.InstanceNumber) if hasattr(ds, 'InstanceNumber') else None
+    is_sr = 'EncapsulatedDocument' in ds
+    ReferencedSOPInstanceUID = None
+    if is_sr:
+        try:
+            ReferencedSOPInstanceUID = _get_reference_uid(ds)
+        except Exception:
+            pass
+    ds = dict(
+        fullpath=fullpath,
+        SeriesDescription=ds.SeriesDescription if hasattr(ds, "SeriesDescription") else "",
+        SeriesInstanceUID=ds.SeriesInstanceUID,
+        SOPInstanceUID=ds.SOPInstanceUID,
+        StudyInstanceUID=ds.StudyInstanceUID,
+        InstanceNumber=InstanceNumber,
+        SliceLocation=float(ds.SliceLocation) if hasattr(ds, 'SliceLocation') else None,
+        ImagePositionPatient=np.array(ds.ImagePositionPatient) if hasattr(ds, 'ImagePositionPatient') else None,
+        ImageOrientationPatient=np.array(ds.ImageOrientationPatient) if hasattr(ds, 'ImageOrientationPatient') else None,
+        Rows=int(ds.Rows) if hasattr(ds, 'Rows') else None,
+        Columns=int(ds.Columns) if hasattr(ds, 'Columns') else None,
+        is_osirix_sr=is_sr,
+        ReferencedSOPInstanceUID=ReferencedSOPInstanceUID,
+        EncapsulatedDocument=bytes(ds.EncapsulatedDocument) if is_sr else None,
+        PixelDataOffset=PixelDataOffset,
+        PixelDataLength=PixelDataLength)
+    return dotdict(ds)
+
+
+def _read_dicom_chunk(dicoms, header_only):
+    """
+    worker of `crawl_dicom_info`, returns the records and the (path, reason) of files failed to read
+    """
+    results, errors = [], []
+    for d in dicoms:
+        try:
+            results.append(read_dicom_record(d, header_only=header_only))
+        except Exception as e:
+            errors.append((d, f"{type(e).__name__}: {e}"))
+    return results, errors
+
+
+def crawl_dicom_info(dicoms, num_workers=1, chunksize=64, header_only=True):
+    """
+    read meta data of `dicoms` with `num_workers` processes.
+    The file list is split into chunks of `chunksize` files, results keep the order of `dicoms`.
+    Returns the records and a list of (path, reason) of files that are not valid dicoms.
+    """
+    from tqdm import tqdm
+    chunks = [dicoms[i:i + chunksize] for i in range(0, len(dicoms), chunksize)]
+    chunk_results = [None] * len(chunks)
+    with tqdm(total=len(dicoms)) as pbar:
+        if num_workers <= 1 or len(chunks) <= 1:
+            for idx, chunk in enumerate(chunks):
+                chunk_results[idx] = _read_dicom_chunk(chunk, header_only)
+                pbar.update(len(chunk))
+        else:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(chunks))) as executor:
+                futures = {executor.submit(_read_dicom_chunk, chunk, header_only): idx for idx, chunk in enumerate(chunks)}
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    chunk_results[idx] = future.result()
+                    pbar.update(len(chunks[idx]))
+    results, errors = [], []
+    for r, e in chunk_results:
+        results.extend(r)
+        errors.extend(e)
+    return results, errors
+
+
+def read_dicom_info(input, header_only=True, num_workers=1):
+    """
+    gather meta data of dicom files, see `read_dicom_record`.
+    Files that cannot be read are skipped and reported in a single warning.
+    """
     if isinstance(input, str):
-        dicoms = sorted(glob(f"{input}/**/*.dcm", recursive = True))
+        from walker import collect_inputs, DICOM, OSIRIX_SR
+        inputs = collect_inputs(input, [DICOM, OSIRIX_SR])
+        dicoms = sorted(inputs[DICOM] + inputs[OSIRIX_SR])
     else:
         assert isinstance(input, list)
         dicoms = input
-    results = []
-    for d in tqdm(dicoms):
-        try:
-            ds = pydicom.dcmread(d)
-        except:
-            warn(f"{d} is not a valid dicom file")
-            continue
-        InstanceNumber = int(ds.InstanceNumber) if hasattr(ds, 'InstanceNumber') else None
-        ds = dict(
-            fullpath=d,
-            SeriesDescription=ds.SeriesDescription if hasattr(ds, "SeriesDescription") else "",
-            SeriesInstanceUID=ds.SeriesInstanceUID,
-            SOPInstanceUID=ds.SOPInstanceUID,
-            StudyInstanceUID=ds.StudyInstanceUID,
-            InstanceNumber=InstanceNumber,
-            SliceLocation=float(ds.SliceLocation) if hasattr(ds, 'SliceLocation') else None,
-            ImagePositionPatient=np.array(ds.ImagePositionPatient) if hasattr(ds, 'ImagePositionPatient') else None,
-            is_osirix_sr=hasattr(ds, 'EncapsulatedDocument'))
-        ds = dotdict(ds)
-        results.append(ds)
+    results, errors = crawl_dicom_info(dicoms, num_workers=num_workers, header_only=header_only)
+    warn_invalid_dicoms(errors, len(dicoms))
     return results
 
 
+def warn_invalid_dicoms(errors, num_files):
+    """
+    summarize (path, reason) of files failed to read in a single warning
+    """
+    if len(errors) > 0:
+        summary = "\n".join([f"  {path}: {reason}" for path, reason in errors])
+        warn(f"{len(errors)} of {num_files} files are not valid dicom files and are ignored:\n{summary}")
+
+
 def group_into_studies(dicoms):
     studies = dict()
     for dcm in dicoms:
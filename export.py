@@ -0,0 +1,90 @@
+import json
+import numpy as np
+from warnings import warn
+from rt_utils.image_helper import get_pixel_to_patient_transformation_matrix
+
+
+EXPORT_FORMATS = ["nifti", "npz", "npy"]
+
+
+def label_map_dtype(num_rois):
+    return np.uint8 if num_rois < 256 else np.uint16
+
+
+def _mask_slices(mask3d):
+    """
+    (z, (h, w) bool mask) of the non-empty slices of a `SparseMask` or a dense (h, w, d) bool volume
+    """
+    if isinstance(mask3d, np.ndarray):
+        return ((z, mask3d[:, :, z]) for z in np.flatnonzero(mask3d.any(axis=(0, 1))))
+    return mask3d.slices()
+
+
+def fill_label_map(label_map, named3dmask):
+    """
+    write the ROIs of `named3dmask` (name -> `SparseMask` or dense (h, w, d) bool mask) into `label_map` in place.
+    ROI #i gets label i+1. Where ROIs overlap the smaller one wins: ROIs are written from the largest to
+    the smallest, so that inner ROIs (e.g. a lesion inside the prostate) are not wiped out by the ROIs
+    around them, and the overwritten voxels are reported in a warning.
+    Returns the label of every name.
+    """
+    labels = {name: label for label, name in enumerate(named3dmask, start=1)}
+    names = list(labels)
+    sizes = {name: sum(int(np.count_nonzero(mask)) for _, mask in _mask_slices(mask3d))
+             for name, mask3d in named3dmask.items()}
+    # (overwritten label, label) -> number of voxels
+    overlaps = dict()
+    for name in sorted(names, key=lambda name: sizes[name], reverse=True):
+        label = labels[name]
+        for z, mask in _mask_slices(named3dmask[name]):
+            target = label_map[:, :, z]
+            covered = target[mask]
+            if covered.any():
+                for old, count in zip(*np.unique(covered[covered > 0], return_counts=True)):
+                    overlaps[(int(old), label)] = overlaps.get((int(old), label), 0) + int(count)
+            target[mask] = label
+    if len(overlaps) > 0:
+        summary = ", ".join([f"{count} voxels of \"{names[old - 1]}\" labeled \"{names[new - 1]}\""
+                             for (old, new), count in overlaps.items()])
+        warn(f"Overlapping ROIs in the label map, smaller ROIs are kept: {summary}.")
+    return labels
+
+
+def export_label_map(named3dmask, series_data, path, fmt="nifti", compress=True):
+    """
+    save the ROIs of a series as a single label map without going through a structure set.
+    `series_data` are the sorted datasets of the series (e.g. `RTStruct.series_data`),
+    they give the patient coordinates of the NIfTI image and the affine stored with the arrays.
+
+    - nifti: `<path>.nii.gz` (or `.nii` if not `compress`)
+    - npz: `<path>.npz` holding `labels` and `affine`, compressed if `compress`
+    - npy: `<path>.npy` filled in place through a memory map
+
+    The label of every ROI is written to `<path>.json`. Returns the path of the label map.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt}, choose from {EXPORT_FORMATS}.")
+    shape = next(iter(named3dmask.values())).shape
+    dtype = label_map_dtype(len(named3dmask))
+    affine = get_pixel_to_patient_transformation_matrix(series_data)
+
+    if fmt == "npy":
+        label_map = np.lib.format.open_memmap(f"{path}.npy", mode="w+", dtype=dtype, shape=shape)
+        labels = fill_label_map(label_map, named3dmask)
+        label_map.flush()
+        del label_map
+        save_path = f"{path}.npy"
+    else:
+        label_map = np.zeros(shape, dtype=dtype)
+        labels = fill_label_map(label_map, named3dmask)
+        if fmt == "nifti":
+            from rt2NIfTI import NiftiWriter
+            with NiftiWriter(compress=compress, num_threads=1) as writer:
+                save_path = writer.save(label_map, affine, path)
+        else:
+            save_path = f"{path}.npz"
+            (np.savez_compressed if compress else np.savez)(save_path, labels=label_map, affine=affine)
+
+    with open(f"{path}.json", 'w') as f:
+        json.dump(dict(labels=labels, affine=affine.tolist()), f, indent=2)
+    return save_path
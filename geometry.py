@@ -0,0 +1,56 @@
+import numpy as np
+from warnings import warn
+
+
+# slice normal of series without ImageOrientationPatient, i.e. axial slices
+AXIAL_NORMAL = np.array([0., 0., 1.])
+
+
+class SeriesGeometry(object):
+    """
+    slice order of a series, computed once from the meta data records of its dicoms
+    (see `dicom_utils.read_dicom_record`) and shared by the converters.
+
+    Slices are sorted by the projection of their ImagePositionPatient onto the slice normal,
+    the cross product of the row and column directions of ImageOrientationPatient.
+    This is the order `rt_utils` uses for the masks of a structure set, so oblique and
+    reverse ordered acquisitions get the right slice index. Slices at the same position
+    keep the order of their paths.
+
+    - `slices[z]` is the record of slice z
+    - `index[SOPInstanceUID]` is the slice index of a dicom
+    """
+    def __init__(self, series) -> None:
+        series = sorted(series, key=lambda x: x.fullpath)
+        orientation = next((s.ImageOrientationPatient for s in series if s.ImageOrientationPatient is not None), None)
+        if orientation is None:
+            self.normal = AXIAL_NORMAL
+        else:
+            orientation = np.asarray(orientation, dtype=np.float64)
+            self.normal = np.cross(orientation[:3], orientation[3:])
+        if all(s.ImagePositionPatient is not None for s in series):
+            positions = np.stack([np.asarray(s.ImagePositionPatient, dtype=np.float64) for s in series])
+            self.positions = positions @ self.normal
+        else:
+            warn(f"Series {series[0].SeriesInstanceUID} has slices without ImagePositionPatient, ordered by InstanceNumber.")
+            self.positions = np.array([s.InstanceNumber or 0 for s in series], dtype=np.float64)
+        order = np.argsort(self.positions, kind="stable")
+        self.positions = self.positions[order]
+        self.slices = [series[i] for i in order]
+        self.index = {s.SOPInstanceUID: z for z, s in enumerate(self.slices)}
+
+    def __repr__(self) -> str:
+        return f"SeriesGeometry(slices={len(self.slices)}, normal={self.normal.round(3).tolist()})"
+
+    def __len__(self):
+        return len(self.slices)
+
+    def __contains__(self, SOPInstanceUID):
+        return SOPInstanceUID in self.index
+
+    def __getitem__(self, z):
+        return self.slices[z]
+
+    @property
+    def fullpaths(self):
+        return [s.fullpath for s in self.slices]
@@ -1,28 +1,65 @@
 import re
+import plistlib
 import numpy as np
 from typing import Any
 from warnings import warn
+from dicom_utils import osirix_get_document
 
 class ROI(object):
-    def __init__(self, name, coords) -> None:
+    def __init__(self, name, coords, type=None, z_positions=None) -> None:
         self.name = name
         self.coords = coords
+        self.type = type
+        self.z_positions = z_positions
     def __repr__(self) -> str:
         return f"ROI(name={self.name}, coords={str(self.coords)})"
 
-def index_all(string, substring):
-    start = -1
-    indice = []
-    while True:
-        try:
-            start = string.index(substring, start+1)
-            if start == -1:
-                break
-            else:
-                indice.append(start)
-        except:
-            break
-    return indice
+
+# bytes removed from the document before searching, see `OsirixSRParser.decode`
+IGNORED_BYTES = (0, 14, 32)
+ROI_MARKER = bytes(range(33, 66))
+# each point starts with one of these markers
+POINT_START = b'\x80\x06_'
+POINT_START_FALLBACK = b'\x80\x19_'
+POINT_END = b'}\xd2'
+POINT_REGEX = re.compile(rb'\d+\.?\d*,\d+\.?\d*')
+NAME_REGEX = re.compile(rb'\}\}(.*?)\_')
+NAME_REGEX_FALLBACK = re.compile(rb'\}(.*?)\_')
+
+
+# parser versions, any other version uses the heuristic byte parser
+STRUCTURED = 'plist'
+
+# ROI types of OsiriX (`ROI.h`)
+ROI_TYPES = {
+    5: 'tMesure',
+    6: 'tROI',
+    9: 'tOval',
+    10: 'tOPolygon',
+    11: 'tCPolygon',
+    12: 'tAngle',
+    13: 'tText',
+    14: 'tArrow',
+    15: 'tPencil',
+    19: 't2DPoint',
+    20: 'tPlain',
+    24: 'tLayerROI',
+    26: 'tAxis',
+    27: 'tDynAngle',
+    28: 'tCurvedROI',
+}
+
+
+def find_all(arr, pattern):
+    """
+    start positions of all occurrences of `pattern` (bytes) in the uint8 array `arr`
+    """
+    if len(arr) < len(pattern):
+        return np.zeros(0, dtype=np.int64)
+    hits = arr[:len(arr) - len(pattern) + 1] == pattern[0]
+    for i in range(1, len(pattern)):
+        hits &= arr[i:len(arr) - len(pattern) + 1 + i] == pattern[i]
+    return np.flatnonzero(hits)
 
 
 class OsirixSRParser(object):
@@ -30,64 +67,149 @@ class OsirixSRParser(object):
         self.version = version
 
     @staticmethod
-    def parse(osx):
-        uint8 = np.array(list(osx.EncapsulatedDocument))
-        rois = []
-        # tmp = decode.replace(chr(0), "").replace(chr(14), "").replace(chr(32), "")
-        tmp = ''.join([chr(i) for i in uint8[np.logical_not((uint8 == 0) + (uint8 == 14) + (uint8 == 32))]])
-        marker = ''.join([chr(i) for i in range(33, 66)])
-        roi_loc = index_all(tmp, marker)
-        if len(roi_loc) > 0:
-            num_roi = len(roi_loc)
-            roi_loc.append(len(tmp)-1)
-
-            for i in range(num_roi):
-                txt1 = tmp[roi_loc[i]:roi_loc[i+1]+1]
-                abc1 = index_all(txt1, '_')
-                if len(abc1) == 0:
-                    abc1 = index_all(txt1,'_')
-                if len(abc1) != 0:
-                    abc2 = np.array(index_all(txt1[abc1[0]:], '}Ò')) + abc1[0]
-                # abc2 = np.array(index_all(txt1[abc1[0]:-1], '}Ò')) + abc1[0] - 1
-                points = []
-                for ind2 in range(len(abc1)):
-                    txt2 = txt1[abc1[ind2]:abc2[ind2]+1]
-                    endofpoint = abc2[ind2]
-                    if len(txt2) > 44:
-                        tt = txt2.index('}')
-                        txt2 = txt2[1:tt]
-                        endofpoint = abc1[ind2] + tt
-                    pt = re.findall('\d+\.?\d*,\d+\.?\d*', txt2)
-                    pt = np.array(pt[0].split(','), dtype=np.float32)[None, :]
-                    points.append(pt)
-                txt3 = txt1[endofpoint-1:abc2[-1]+1]
-
-                #regex = r"}(.*)+"
-                #regex = r"}[a-zA-Z]+|{[^{}]+_"
-                # regex = r"(?<=\})([a-zA-Z0-9]+)(?=\_)"
-                matches = re.findall(r'\}\}(.*?)\_', txt3)
-                if len(matches) == 0:
-                    matches = re.findall(r'\}(.*?)\_', txt3)
-                if len(matches) < 1:
-                    warn(f"Cannot parse name of roi\#{i}")
-                    name = 'You-have-to-rename'
+    def decode(doc):
+        """
+        decode the ROIs of an OsirixSR EncapsulatedDocument (bytes or memoryview).
+        Returns the ROI names, the (N, 2) float32 coordinates of all ROIs and
+        the offsets such that `coords[offsets[i]:offsets[i+1]]` are the points of ROI #i.
+        """
+        uint8 = np.frombuffer(doc, dtype=np.uint8)
+        uint8 = uint8[~np.isin(uint8, IGNORED_BYTES)]
+        buf = uint8.tobytes()
+        roi_loc = find_all(uint8, ROI_MARKER)
+        # ROI i spans buf[roi_start[i]:roi_end[i]]
+        roi_start = roi_loc
+        roi_end = np.append(roi_loc[1:] + 1, len(buf))
+        starts = find_all(uint8, POINT_START)
+        starts_fallback = find_all(uint8, POINT_START_FALLBACK)
+        closes = find_all(uint8, POINT_END)
+
+        names, spans, num_points = [], [], []
+        for i, (start, end) in enumerate(zip(roi_start, roi_end)):
+            abc1 = starts[np.searchsorted(starts, start):np.searchsorted(starts, end - 2)]
+            if len(abc1) == 0:
+                abc1 = starts_fallback[np.searchsorted(starts_fallback, start):np.searchsorted(starts_fallback, end - 2)]
+            if len(abc1) == 0:
+                warn(f"Cannot parse points of roi #{i}")
+                continue
+            # both bytes of the end marker have to be inside the ROI
+            abc2 = closes[np.searchsorted(closes, abc1[0]):np.searchsorted(closes, end - 1)]
+            n, endofpoint = 0, abc1[0]
+            for u, c in zip(abc1, abc2):
+                pos, endpos = u, c + 1
+                endofpoint = c
+                if endpos - pos > 44:
+                    tt = buf.find(b'}', pos, endpos) - pos
+                    pos, endpos = u + 1, u + tt
+                    endofpoint = u + tt
+                match = POINT_REGEX.search(buf, pos, endpos)
+                if match is None:
+                    continue
+                spans.append(match.group())
+                n += 1
+            num_points.append(n)
+
+            txt3 = (endofpoint - 1, abc2[-1] + 1) if len(abc2) > 0 else (endofpoint - 1, end)
+            matches = NAME_REGEX.findall(buf, *txt3)
+            if len(matches) == 0:
+                matches = NAME_REGEX_FALLBACK.findall(buf, *txt3)
+            if len(matches) < 1:
+                warn(f"Cannot parse name of roi #{i}")
+                name = 'You-have-to-rename'
+            else:
+                name = matches[0].decode('latin-1')
+                if len(name) > 0:
+                    if len(name) > 2 and name[-1] == "P":
+                        name = name[0:-1]
+                    if name[-1] == "P" and len(names) > 0:
+                        name = names[-1]
+                    else:
+                        name = name[1:]
                 else:
-                    name = matches[0]
-                    if len(name) > 0:
-                        if len(name) > 2 and name[-1] == "P":
-                            name = name[0:-1]
-                        if name[-1] == "P" and i > 0:
-                            name = rois[i-1].name
-                        else:
-                            name = name[1:]
+                    if len(names) > 0 and names[-1]:
+                        name = names[-1]
                     else:
-                        if i > 0 and rois[i-1].name:
-                            name = rois[i-1].name
-                        else:
-                            name = "Couldn't parse ROI name from OsirixSR"
-                points = np.concatenate(points, axis=0)
-                rois.append(ROI(name, points))
-        return rois
+                        name = "Couldn't parse ROI name from OsirixSR"
+            names.append(name)
+
+        if len(spans) > 0:
+            coords = np.fromstring(b','.join(spans).decode('ascii'), dtype=np.float64, sep=',')
+            coords = coords.astype(np.float32).reshape(-1, 2)
+        else:
+            coords = np.zeros((0, 2), dtype=np.float32)
+        offsets = np.concatenate([[0], np.cumsum(num_points, dtype=np.int64)])
+        return names, coords, offsets
+
+    @staticmethod
+    def decode_structured(doc):
+        """
+        decode the NSKeyedArchiver binary plist of an OsirixSR EncapsulatedDocument.
+        Returns the same (names, coords, offsets) as `decode` plus, for each ROI,
+        a dict with its OsiriX `type` and the `z_positions` (slice indices) it is drawn on.
+        Raises `plistlib.InvalidFileException` if the document is not an archive.
+        """
+        doc = bytes(doc)
+        try:
+            archive = plistlib.loads(doc)
+        except plistlib.InvalidFileException:
+            # dicom pads odd-length values with a trailing zero byte
+            if not doc.endswith(b'\x00'):
+                raise
+            archive = plistlib.loads(doc[:-1])
+        if archive.get('$archiver') != 'NSKeyedArchiver':
+            raise plistlib.InvalidFileException(f"Unknown archiver {archive.get('$archiver')}")
+        objects = archive['$objects']
+
+        def resolve(value):
+            while isinstance(value, plistlib.UID):
+                value = objects[value.data]
+            return None if value == '$null' else value
+
+        names, points, num_points, info = [], [], [], []
+        for i, roi in enumerate(resolve(resolve(archive['$top']['root'])['NS.objects'])):
+            roi = resolve(roi)
+            name = resolve(roi.get('name'))
+            if not name:
+                warn(f"Cannot parse name of roi #{i}")
+                name = 'You-have-to-rename'
+            roi_type = int(roi.get('type', -1))
+            roi_points = [resolve(resolve(p)['$0']) for p in resolve(roi.get('points', {})).get('NS.objects', [])]
+            if len(roi_points) == 0:
+                warn(f"roi #{i} \"{name}\" of type {ROI_TYPES.get(roi_type, roi_type)} has no points, ignored")
+                continue
+            z_positions = [int(resolve(z)) for z in resolve(roi.get('zPositions', {})).get('NS.objects', [])]
+            names.append(name)
+            points.extend(p.strip('{}') for p in roi_points)
+            num_points.append(len(roi_points))
+            info.append(dict(type=ROI_TYPES.get(roi_type, roi_type), z_positions=z_positions))
+
+        if len(points) > 0:
+            coords = np.fromstring(','.join(points), dtype=np.float64, sep=',')
+            coords = coords.astype(np.float32).reshape(-1, 2)
+        else:
+            coords = np.zeros((0, 2), dtype=np.float32)
+        offsets = np.concatenate([[0], np.cumsum(num_points, dtype=np.int64)])
+        return names, coords, offsets, info
+
+    @staticmethod
+    def parse(osx):
+        names, coords, offsets = OsirixSRParser.decode(osirix_get_document(osx))
+        return [ROI(name, coords[offsets[i]:offsets[i+1]]) for i, name in enumerate(names)]
+
+    @staticmethod
+    def parse_structured(osx):
+        """
+        parse ROIs with `decode_structured`, falls back to the heuristic `parse`
+        if the document cannot be decoded as an archive
+        """
+        try:
+            names, coords, offsets, info = OsirixSRParser.decode_structured(osirix_get_document(osx))
+        except Exception as e:
+            warn(f"Cannot decode OsirixSR archive ({e}), falling back to the heuristic parser.")
+            return OsirixSRParser.parse(osx)
+        return [ROI(name, coords[offsets[i]:offsets[i+1]], **info[i]) for i, name in enumerate(names)]
 
     def __call__(self, *args: Any, **kwds: Any) -> Any:
+        if self.version == STRUCTURED:
+            return self.parse_structured(*args, **kwds)
         return self.parse(*args, **kwds)
@@ -0,0 +1,102 @@
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+from pydicom import dcmread
+from vlkit import str2color
+
+
+def to_uint8(img):
+    """
+    min-max normalize a slice into uint8
+    """
+    img = np.asarray(img, dtype=np.float32)
+    lo, hi = float(img.min()), float(img.max())
+    if hi <= lo:
+        return np.zeros(img.shape, dtype=np.uint8)
+    return ((img - lo) * (255 / (hi - lo))).astype(np.uint8)
+
+
+def composite(gray, masks, colors, alpha=0.3):
+    """
+    blend the (h, w) bool `masks` with their uint8 `colors` into the uint8 slice `gray`,
+    returns an (h, w, 3) uint8 image. All arithmetic is done in integers.
+    """
+    overlay = np.repeat(gray[:, :, None], 3, axis=2)
+    a = int(round(alpha * 256))
+    for mask, color in zip(masks, colors):
+        pixels = overlay[mask].astype(np.uint16)
+        overlay[mask] = ((pixels * (256 - a) + color.astype(np.uint16) * a) >> 8).astype(np.uint8)
+    return overlay
+
+
+def imwrite(path, img):
+    """
+    `cv2.imwrite` that raises instead of returning False when the image cannot be written
+    """
+    if not cv2.imwrite(path, img):
+        raise OSError(f"Cannot write image {path}")
+
+
+def roi_color(name):
+    return np.round(np.array(str2color(name), dtype=np.float32) * 255).astype(np.uint8)
+
+
+class OverlayWriter(object):
+    """
+    render the masks and QA overlays of a series, encoding and writing the files
+    is handed to a pool of `num_threads` background threads.
+
+    For every ROI and non-empty slice the mask is written to `<slice>.<roi>.npy` (as `mask_dtype`)
+    and `<slice>.<roi>_mask.png`. Every `overlay_every`-th annotated slice is decoded
+    once and all its ROIs are composited into `<slice>.overlay.jpg`,
+    `overlay_every=0` turns the overlays off.
+    """
+    def __init__(self, num_threads=4, overlay_every=1, alpha=0.3, mask_dtype=bool) -> None:
+        self.overlay_every = overlay_every
+        self.mask_dtype = mask_dtype
+        self.alpha = alpha
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, func, *args):
+        self.futures.append(self.executor.submit(func, *args))
+
+    def write_series(self, slice_paths, save_paths, named3dmask):
+        """
+        `slice_paths[z]` is the dicom of slice z, and `save_paths[z]` the prefix of its output files.
+        Returns the number of slices decoded for overlays.
+        """
+        annotated = set()
+        for name, mask3d in named3dmask.items():
+            for z, mask in mask3d.slices():
+                annotated.add(z)
+                self.submit(np.save, f"{save_paths[z]}.{name}.npy", mask.astype(self.mask_dtype))
+                self.submit(imwrite, f"{save_paths[z]}.{name}_mask.png", mask.astype(np.uint8) * 255)
+        if self.overlay_every <= 0:
+            return 0
+        colors = {name: roi_color(name) for name in named3dmask}
+        overlaid = sorted(annotated)[::self.overlay_every]
+        for z in overlaid:
+            gray = to_uint8(dcmread(slice_paths[z]).pixel_array)
+            names = [name for name in named3dmask if z in named3dmask[name]]
+            overlay = composite(gray, [named3dmask[name].get_slice(z) for name in names],
+                                [colors[name] for name in names], alpha=self.alpha)
+            self.submit(imwrite, f"{save_paths[z]}.overlay.jpg", overlay)
+        return len(overlaid)
+
+    def close(self):
+        """
+        wait for all pending writes, errors of the writes are raised here
+        """
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown()
@@ -1,76 +1,213 @@
-import csv, json, cv2
+import csv, json, itertools
 import numpy as np
 from warnings import warn
 from dicom_utils import dotdict
 
 
-def parse_json(fn: str):
-    data = json.load(open(fn, "r"))
-    if "Images" not in data or len(data["Images"]) == 0 or len(data["Images"][0]["ROIs"]) == 0:
-        warn(f"No ROI found in {fn}.")
+# characters allowed in point strings
+POINT_CHARS = "0123456789.,-+eE() "
+POINT_TABLE = str.maketrans("", "", POINT_CHARS)
+
+
+def parse_points(points, dim=None):
+    """
+    parse OsiriX point strings such as `["(1.5, 2.0)", "(3.0, 4.5)"]` (`Point_px` or `Point_mm`)
+    into a (N, dim) float32 array, without evaluating them.
+    The dimension is inferred from the first point if `dim` is None.
+    """
+    if len(points) == 0:
+        return np.zeros((0, 2 if dim is None else dim), dtype=np.float32)
+    if dim is None:
+        dim = points[0].count(",") + 1
+    text = ",".join(points)
+    if len(text.translate(POINT_TABLE)) > 0:
+        raise ValueError(f"Invalid point in {points[:3]}...")
+    values = np.fromstring(text.replace("(", " ").replace(")", " "), dtype=np.float64, sep=",")
+    if len(values) != len(points) * dim:
+        raise ValueError(f"Expected {len(points)} points of dimension {dim}, got {len(values)} values.")
+    return values.astype(np.float32).reshape(-1, dim)
+
+
+def iter_json_images(fn: str):
+    """
+    iterate over the images (with their ROIs) of a json export.
+    With `ijson` installed the file is parsed incrementally so that only one image
+    is in memory at a time, otherwise the whole file is loaded with `json`.
+    """
+    try:
+        import ijson
+    except ImportError:
+        with open(fn, "r") as f:
+            data = json.load(f)
+        yield from data.get("Images", [])
         return
-    data = data["Images"]
-    SeriesInstanceUID = data[0]["ROIs"][0]["SeriesInstanceUID"]
-    StudyInstanceUID = data[0]["ROIs"][0]["StudyInstanceUID"]
-    h, w, d = data[0]["ImageHeight"], data[0]["ImageWidth"], data[0]["ImageTotalNum"]
-
-    results = dict(
-        StudyInstanceUID=StudyInstanceUID,
-        SeriesInstanceUID=SeriesInstanceUID
-    )
+    with open(fn, "rb") as f:
+        yield from ijson.items(f, "Images.item", use_float=True)
 
-    roi_names = [roi["Name"] for image in data for roi in image["ROIs"]]
 
-    named3dmask = dotdict()
-    for name in roi_names:
-        named3dmask[name] = np.zeros((h, w, d), dtype=bool)
+def parse_json(fn: str):
+    from sparse_mask import SparseMask
+    results, named3dmask = None, dotdict()
+    for image in iter_json_images(fn):
+        if results is None:
+            if len(image["ROIs"]) == 0:
+                break
+            results = dict(
+                StudyInstanceUID=image["ROIs"][0]["StudyInstanceUID"],
+                SeriesInstanceUID=image["ROIs"][0]["SeriesInstanceUID"]
+            )
+            h, w, d = image["ImageHeight"], image["ImageWidth"], image["ImageTotalNum"]
 
-    for image in data:
         ImageIndex = image["ImageIndex"]
         assert image["ImageHeight"] == h and image["ImageWidth"] == w
 
         for roi in image["ROIs"]:
             name = roi["Name"]
             if name not in named3dmask:
-                named3dmask[name] = np.zeros((h, w, d), dtype=bool)
-            points = np.array([eval(point) for point in roi['Point_px']])
+                named3dmask[name] = SparseMask(h, w, d)
+            points = parse_points(roi['Point_px'], dim=2)
+
+            assert roi["SeriesInstanceUID"] == results["SeriesInstanceUID"]
+            assert roi["StudyInstanceUID"] == results["StudyInstanceUID"]
 
-            assert roi["SeriesInstanceUID"] == SeriesInstanceUID
-            assert roi["StudyInstanceUID"] == StudyInstanceUID
+            named3dmask[name].fill_poly(ImageIndex, points)
 
-            mask1 = named3dmask[name][:, :, ImageIndex].astype(np.uint8)
-            cv2.fillPoly(mask1, [points.astype(np.int32)], color=1)
-            named3dmask[name][:, :, ImageIndex] = mask1.astype(bool)
-    
+    if results is None:
+        warn(f"No ROI found in {fn}.")
+        return
     results["named3dmask"] = named3dmask
     return dotdict(results)
 
 
-def parse_csv(fn):
-    table = list(csv.reader(open(fn, "r")))
-    header = table[0]
-    def key2idx(key: str):
-        if key in header: 
-            return table[0].index(key)
-        else:
-            raise ValueError(f"Unknown key={key} in header {header}.")
-
-    keys = ["ImageNo", "RoiName", "SOPInstanceUID", "StudyInstanceUID", "SeriesInstanceUID"]
+def load_json(fn: str):
+    """
+    read the ROIs of a json export in a single pass.
+    Returns a dotdict with the Study/SeriesInstanceUID, the image height `h` and width `w`
+    and the `rois` (Name, SOPInstanceUID, ImageIndex and (N, 2) float32 `points_px`),
+    or None if the export has no ROI.
+    """
+    results, rois = None, []
+    for img_idx, image in enumerate(iter_json_images(fn)):
+        if len(image["ROIs"]) == 0:
+            warn(f"No ROI found in image #{img_idx} of {fn}.")
+            continue
+        if results is None:
+            results = dotdict(
+                StudyInstanceUID=image["ROIs"][0]["StudyInstanceUID"],
+                SeriesInstanceUID=image["ROIs"][0]["SeriesInstanceUID"],
+                h=image["ImageHeight"],
+                w=image["ImageWidth"])
+        assert results.h == image["ImageHeight"] and results.w == image["ImageWidth"]
+        for roi in image["ROIs"]:
+            assert roi["SeriesInstanceUID"] == results.SeriesInstanceUID
+            rois.append(dict(
+                Name=roi["Name"],
+                SOPInstanceUID=roi["SOPInstanceUID"],
+                ImageIndex=image.get("ImageIndex"),
+                points_px=parse_points(roi["Point_px"], dim=2)))
+    if results is None:
+        warn(f"No ROI found in {fn}.")
+        return None
+    results.rois = rois
+    return results
+
+
+CSV_KEYS = ["ImageNo", "RoiName", "SOPInstanceUID", "StudyInstanceUID", "SeriesInstanceUID"]
+# every point is stored as mmX, mmY, mmZ, pxX, pxY starting from the "mmX" column
+CSV_POINT_FIELDS = 5
+
+
+def csv_columns(header, fn=None):
+    """
+    resolve the column indices of `CSV_KEYS`, "NumOfPoints" and "mmX" once from the csv header,
+    the point values are the trailing columns starting from "mmX"
+    """
+    columns = dotdict()
+    for key in CSV_KEYS + ["NumOfPoints", "mmX"]:
+        if key not in header:
+            raise ValueError(f"Unknown key={key} in header {header}" + (f" of {fn}." if fn else "."))
+        columns[key] = header.index(key)
+    assert all(idx < columns.mmX for idx in columns.values() if idx != columns.mmX), \
+        f"Point values are not the last columns in header {header}."
+    return columns
+
+
+def split_csv_line(line, start):
+    """
+    split a csv line into its first `start` fields and the raw text of the remaining (point) fields,
+    only lines with quoted fields go through `csv.reader`
+    """
+    line = line.rstrip("\r\n")
+    if '"' in line:
+        fields = next(csv.reader([line]))
+        return fields[:start], ",".join(fields[start:])
+    fields = line.split(",", start)
+    return fields[:start], fields[start] if len(fields) > start else ""
+
+
+def parse_csv_lines(lines, columns):
+    """
+    parse csv lines into a dotdict of `rois`, the (N, 5) float32 `points` of all lines
+    and the `offsets` such that `points[offsets[i]:offsets[i+1]]` are the points of ROI #i.
+    The point values of all lines are converted in a single call and
+    the `points_mm` and `points_px` of each ROI are views into `points`.
+    """
+    rows, spans, num_points = [], [], []
+    for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        row, span = split_csv_line(line, columns.mmX)
+        n = int(row[columns.NumOfPoints])
+        num_values = span.count(",") + 1 if len(span) > 0 else 0
+        assert num_values == n * CSV_POINT_FIELDS, \
+            f"{num_values} values for {n} points of ROI on image {row[columns.ImageNo]}"
+        rows.append(row)
+        num_points.append(n)
+        if n > 0:
+            spans.append(span)
+    if len(spans) > 0:
+        points = np.fromstring(",".join(spans), dtype=np.float64, sep=",").astype(np.float32)
+    else:
+        points = np.zeros(0, dtype=np.float32)
+    points = points.reshape(-1, CSV_POINT_FIELDS)
+    offsets = np.concatenate([[0], np.cumsum(num_points, dtype=np.int64)])
+    assert len(points) == offsets[-1], "Malformed point values"
 
     rois = []
-    for row in table[1:]:
-        roi = dict()
-        for k in keys:
-            roi[k] = row[key2idx(k)]
-        # parse points
-        num_points = int(row[key2idx("NumOfPoints")])
-        point_start_idx = key2idx("mmX")
-        assert len(row[point_start_idx:]) == num_points * 5
-        points = np.array(row[point_start_idx:], dtype=np.float32).reshape(num_points, 5)
-        #
-        roi["points_mm"], roi["points_px"] = np.hsplit(points, [3])
-        roi["num_points"] = num_points
+    for i, row in enumerate(rows):
+        roi = {k: row[columns[k]] for k in CSV_KEYS}
+        roi["points_mm"] = points[offsets[i]:offsets[i + 1], :3]
+        roi["points_px"] = points[offsets[i]:offsets[i + 1], 3:]
+        roi["num_points"] = num_points[i]
         rois.append(roi)
+    return dotdict(rois=rois, points=points, offsets=offsets)
+
+
+def iter_csv(fn, chunksize=4096):
+    """
+    lazily parse a (possibly very large) csv export in chunks of `chunksize` lines,
+    yields the same dotdict as `parse_csv_lines` for every chunk
+    """
+    with open(fn, "r", newline="") as f:
+        columns = csv_columns(next(csv.reader([f.readline()])), fn)
+        while True:
+            lines = list(itertools.islice(f, chunksize))
+            if len(lines) == 0:
+                break
+            yield parse_csv_lines(lines, columns)
+
+
+def load_csv(fn):
+    """
+    parse a whole csv export at once, see `parse_csv_lines`
+    """
+    with open(fn, "r", newline="") as f:
+        columns = csv_columns(next(csv.reader([f.readline()])), fn)
+        return parse_csv_lines(f, columns)
+
+
+def parse_csv(fn):
+    rois = load_csv(fn).rois
 
     for roi in rois:
         assert roi["SeriesInstanceUID"] == rois[0]["SeriesInstanceUID"] and \
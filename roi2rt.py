@@ -1,242 +1,251 @@
-import os, shutil, argparse
-from glob import glob
+import os, argparse
 import os.path as osp
 from warnings import warn
-import os, sys, json, shutil, pathlib, pydicom
 import numpy as np
-import cv2
-from vlkit import normalize
-from rt_utils import RTStructBuilder
-from tqdm import tqdm
-from pydicom import dcmread
-
-
-def parse_args():
+from dicom_utils import (
+    dotdict,
+    read_dicom_info,
+    group_into_series,
+    group_into_studies,
+    get_common_prefix)
+from dicom_index import open_dicom_index
+from parse_roi import load_json
+from rtstruct_utils import load_series_headers, create_rtstruct
+from scheduler import run_jobs, warn_failed_jobs
+from sparse_mask import SparseMask
+from geometry import SeriesGeometry
+from staging import Stager, STAGE_METHODS
+from walker import collect_inputs, add_walk_arguments, DICOM, ROI_JSON
+from tracing import Tracer, add_trace_arguments, tracer_from_args, header_bytes
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
-        prog="rtconvert",
-        usage="rtconvert path/to/dicoms/",
-        description="""Convert annotations to dicom-rt structure set.
-        It will search all suported annotations (currently support OsirixSR)
-        and corresponding dicom files, and convert annotations into dicom-rt structure.
+        prog="roi2rt",
+        usage="roi2rt path/to/dicoms/",
+        description="""Convert json ROI exports to dicom-rt structure sets.
+        It will search all json ROIs and the dicom series they are drawn on,
+        and save a structure set per annotated series.
         """
         )
     parser.add_argument('dicom')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes used to read dicom meta data and convert series')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='maximum number of series being converted at the same time (default: 2 x workers)')
+    parser.add_argument('--ordered', action='store_true',
+                        help='report converted series in a deterministic order')
+    parser.add_argument('--index', action='store_true',
+                        help='keep a persistent meta data index in the data directory and only re-read changed files')
     parser.add_argument('--save-to', type=str, default=None)
-    
-    args =  parser.parse_args()
+    parser.add_argument('--polygon', action='store_true',
+                        help='write the json points as contours instead of rasterizing and re-contouring them')
+    parser.add_argument('--overlay-every', type=int, default=1,
+                        help='write the overlay of every N-th annotated slice, 0 to write no overlay')
+    add_walk_arguments(parser)
+    parser.add_argument('--stage', type=str, default='auto', choices=STAGE_METHODS,
+                        help='how the series are placed into the save-to directory, "auto" hardlinks or reflinks and falls back to copy')
+    add_trace_arguments(parser)
+
+    args =  parser.parse_args(argv)
     return args
 
-class dotdict(dict):
-    """dot.notation access to dictionary attributes"""
-    __getattr__ = dict.get
-    __setattr__ = dict.__setitem__
-    __delattr__ = dict.__delitem__
-
 
-def read_dicom_info(input):
-    if isinstance(input, str):
-        dicoms = sorted(glob(f"{input}/**/*.dcm", recursive = True))
-    else:
-        assert isinstance(input, list)
-        dicoms = input
-    results = []
-
-    for d in tqdm(dicoms):
-        try:
-            ds = pydicom.dcmread(d)
-        except:
-            warn(f"{d} is not a valid dicom file")
-            continue
-        InstanceNumber = int(ds.InstanceNumber) if hasattr(ds, 'InstanceNumber') else None
-        ds = dict(
-            fullpath=d,
-            SeriesDescription=ds.SeriesDescription if hasattr(ds, "SeriesDescription") else "",
-            SeriesInstanceUID=ds.SeriesInstanceUID,
-            SOPInstanceUID=ds.SOPInstanceUID,
-            StudyInstanceUID=ds.StudyInstanceUID,
-            InstanceNumber=InstanceNumber,
-            SliceLocation=float(ds.SliceLocation) if hasattr(ds, 'SliceLocation') else None,
-            ImagePositionPatient=np.array(ds.ImagePositionPatient) if hasattr(ds, 'ImagePositionPatient') else None,
-            is_osirix_sr=hasattr(ds, 'EncapsulatedDocument'))
-        results.append(dotdict(ds))
-    return results
-
-
-def group_into_series(dicoms):
-    """
-    group dicoms into different series according to their
-    `SeriesInstanceUID`
+def convert_series(job):
     """
-    series = dict()
-    for ds in dicoms:
-        if ds.SeriesInstanceUID not in series:
-            series[ds.SeriesInstanceUID] = [ds]
-        else:
-            series[ds.SeriesInstanceUID].append(ds)
-    return series
-
-
-def get_common_prefix(paths):
-    shortest = 0
-    # find the shallowest file path
-    for idx, f in enumerate(paths):
-        if len(paths[shortest].split(osp.sep)) <len(f.split(osp.sep)):
-            shortest = idx
-    shortest = paths[shortest].split(osp.sep)
-    for i in range(len(shortest), 0, -1):
-        path = osp.sep.join(shortest[:i])
-        if all([pathlib.PurePath(p).is_relative_to(path) for p in paths]):
-            return path
-
-
-def group_into_studies(dicoms):
+    convert the json ROIs of one series into a dicom-rt structure set,
+    the series is read once and its structure set is built once.
+    If `job.save_to` is given the series and the visualizations are written there.
+    Returns the path of the saved structure set.
     """
-    Group dicoms into studies according to StudyInstanceUID
-    """
-    studies = dict()
-    for dcm in dicoms:
-        if not hasattr(dcm, "StudyInstanceUID"):
-            warn(f"{dcm.fullpath} does not have 'StudyInstanceUID' attribute")
-            continue
-        if dcm.StudyInstanceUID in studies:
-            studies[dcm.StudyInstanceUID].append(dcm)
+    with job.tracer.span("series", study=job.study_instance_uid, series=job.SeriesInstanceUID):
+        return _convert_series(job, job.tracer)
+
+
+def _convert_series(job, tracer):
+    series = job.geometry.slices
+    try:
+        with tracer.span("load_headers", series=job.SeriesInstanceUID) as span:
+            series_data = load_series_headers(series, StudyID=job.study_instance_uid)
+            span.files += len(series)
+            span.bytes_read += header_bytes(series)
+        rtstruct = create_rtstruct(series_data)
+    except Exception as e:
+        raise RuntimeError(f"Cannot create RTStructure for series {job.SeriesInstanceUID}: {e}")
+
+    if job.save_to is not None:
+        with tracer.span("staging", series=job.SeriesInstanceUID, method=job.stage) as span:
+            stager = Stager(job.stage)
+            for s in series:
+                stager.stage(s.fullpath, osp.join(job.save_to, osp.relpath(s.fullpath, start=job.data_dir)))
+            span.files += len(series)
+
+    if job.polygon:
+        from rt_utils.utils import Polygon2D
+    h, w = job.h, job.w
+    # in polygon mode the json points go straight into the structure set,
+    # masks are only rasterized for the visualization
+    rasterize = job.save_to is not None or not job.polygon
+    named3dmask = dict()
+    named_polygons = dict()
+    # slice index -> dicom of the annotated slices
+    slice_paths = dict()
+    with tracer.span("rasterization", series=job.SeriesInstanceUID) as span:
+        for roi in job.rois:
+            slice_idx = job.geometry.index[roi["SOPInstanceUID"]]
+
+            roi_name = roi["Name"]
+            points = roi["points_px"]
+            span.rois += 1
+            span.points += len(points)
+
+            if rasterize:
+                if roi_name not in named3dmask:
+                    named3dmask[roi_name] = SparseMask(h, w, len(series))
+                named3dmask[roi_name].fill_poly(slice_idx, points)
+
+            if job.polygon:
+                if roi_name not in named_polygons:
+                    named_polygons[roi_name] = [Polygon2D(coords=[], h=h, w=w)] * len(series)
+                if len(named_polygons[roi_name][slice_idx].coords) > 0:
+                    warn(f"Multiple \"{roi_name}\" ROIs on slice #{slice_idx} of {job.series_prefix}, only the last one is kept.")
+                named_polygons[roi_name][slice_idx] = Polygon2D(coords=points.flatten().tolist(), h=h, w=w)
+
+            slice_paths[slice_idx] = series[slice_idx].fullpath
+
+    if job.save_to is not None:
+        from overlay import OverlayWriter
+        with tracer.span("overlays", series=job.SeriesInstanceUID) as span:
+            with OverlayWriter(overlay_every=job.overlay_every, mask_dtype=np.uint8) as writer:
+                span.pixel_decodes += writer.write_series(
+                    slice_paths,
+                    {z: osp.join(job.save_to, osp.relpath(p, start=job.data_dir)) for z, p in slice_paths.items()},
+                    named3dmask)
+
+    with tracer.span("rt_build", series=job.SeriesInstanceUID) as span:
+        if job.polygon:
+            for name, polygons in named_polygons.items():
+                rtstruct.add_roi(polygon=polygons, name="kai_"+name)
         else:
-            studies[dcm.StudyInstanceUID] = [dcm]
-    return studies
-
-
-def build_SOPInstanceUID_lookup_table(dicoms):
-    """
-    build look-up-table from SOPInstanceUID to dicom
-    """
-    SOPInstanceUID_lookup_table = dict()
-    for ds in dicoms:
-        SOPInstanceUID_lookup_table[ds.SOPInstanceUID] = ds
-    return SOPInstanceUID_lookup_table
-
-
-def process(data_dir):
+            for name, mask in named3dmask.items():
+                rtstruct.add_roi(mask=mask.to_dense(), name="kai_"+name, approximate_contours=False)
+        span.rois += len(named_polygons) if job.polygon else len(named3dmask)
+    save_path = osp.join(job.study_prefix, job.SeriesInstanceUID+"_rtstruct.dcm")
+    with tracer.span("rt_save", series=job.SeriesInstanceUID) as span:
+        rtstruct.save(save_path)
+        span.files += 1
+        span.bytes_written += osp.getsize(save_path)
+    return save_path
+
+
+def process(data_dir, save_to=None, num_workers=1, use_index=False, polygon=False, max_in_flight=None, ordered=False,
+            overlay_every=1, stage="auto", include=None, exclude=None, max_depth=None, tracer=None):
+    tracer = Tracer() if tracer is None else tracer
     print(f"Searching dicom files in {data_dir}, this may take a while.")
-    dicoms = glob(f"{data_dir}/**/*.dcm", recursive=True)
+    with tracer.span("walk") as span:
+        inputs = collect_inputs(data_dir, [DICOM, ROI_JSON], include=include, exclude=exclude, max_depth=max_depth)
+        dicoms = inputs[DICOM]
+        span.files += len(dicoms) + len(inputs[ROI_JSON])
     if len(dicoms) == 0:
         raise RuntimeError(f"no dicom file found in {data_dir}")
     else:
         print(f"Found {len(dicoms)} dicom files, gathering their meta data.")
-    dicom_info = read_dicom_info(dicoms)
-    studies = group_into_studies(dicom_info)
+    with tracer.span("scan", index=use_index) as span:
+        if use_index:
+            index = open_dicom_index(data_dir, dicoms, num_workers=num_workers)
+            studies = index.studies()
+        else:
+            dicom_info = read_dicom_info(dicoms, num_workers=num_workers)
+            studies = group_into_studies(dicom_info)
+            span.files += len(dicom_info)
+            span.bytes_read += header_bytes(dicom_info)
 
-    # find all json ROIs
-    roi_jsons = glob(f"{data_dir}/**/*.json", recursive=True)
+    # find all json ROIs, each json is parsed once and routed to its study and series
+    roi_jsons = inputs[ROI_JSON]
     if len(roi_jsons) == 0:
         warn(f"No json found in {data_dir}.")
-        return
+        return []
     print(f"Found {len(roi_jsons)} jsons in {data_dir}.")
+    study2jsons = dict()
+    for js in roi_jsons:
+        with tracer.span("json_parsing", json=js) as span:
+            roi_data = load_json(js)
+            span.files += 1
+            span.bytes_read += osp.getsize(js)
+            if roi_data is not None:
+                span.rois += len(roi_data.rois)
+                span.points += sum(len(roi["points_px"]) for roi in roi_data.rois)
+        if roi_data is None:
+            continue
+        roi_data.json = js
+        study2jsons.setdefault(roi_data.StudyInstanceUID, []).append(roi_data)
 
+    jobs = []
     for study_idx, (study_instance_uid, study_dicom_info) in enumerate(studies.items()):
-        dicom_paths = [dcm.fullpath for dcm in study_dicom_info]
-        study_prefix = get_common_prefix(dicom_paths)
+        if study_instance_uid not in study2jsons:
+            continue
+        study_prefix = get_common_prefix([dcm.fullpath for dcm in study_dicom_info])
         print(f"Processing study {study_idx}: {study_prefix}.")
-
-        SOPInstanceUID_lookup_table = build_SOPInstanceUID_lookup_table(study_dicom_info)
-        series_instance_uid2series = group_into_series(dicom_info)
-
-        for js in roi_jsons:
-            roi_data = json.load(open(js, 'r'))
-            if "Images" not in roi_data or len(roi_data["Images"]) == 0:
-                warn(f"No ROI found in {js}.")
+        with tracer.span("group_series", study=study_instance_uid):
+            if use_index:
+                series_instance_uid2series = index.series(study_instance_uid)
+            else:
+                series_instance_uid2series = group_into_series(study_dicom_info)
+
+        # jsons annotating the same series end up in one structure set
+        series2jsons = dict()
+        for roi_data in study2jsons.pop(study_instance_uid):
+            if roi_data.SeriesInstanceUID not in series_instance_uid2series:
+                warn(f"Series {roi_data.SeriesInstanceUID} of {roi_data.json} not found in study {study_prefix}.")
                 continue
-
-            if study_instance_uid != roi_data["Images"][0]["ROIs"][0]["StudyInstanceUID"]:
-                print(f"json {js} does not correspond to study {study_prefix}.")
-                continue
-
-            SeriesInstanceUID = roi_data["Images"][0]["ROIs"][0]["SeriesInstanceUID"]
-
-            h, w = roi_data["Images"][0]["ImageHeight"], roi_data["Images"][0]["ImageWidth"]
-            
-            
-            tmp_series_dir = osp.join("/tmp", "roi2rtstruct", "series", SeriesInstanceUID)
-            os.makedirs(tmp_series_dir, exist_ok=True)
-
-            series = sorted(series_instance_uid2series[SeriesInstanceUID], key=lambda x:x['fullpath'])
-            series_prefix = get_common_prefix([s.fullpath for s in series])
-
-            if args.save_to is not None:
-                for s in series:
-                    relpath = osp.relpath(s.fullpath, start=data_dir)
-                    save_path = osp.join(args.save_to, relpath)
-                    os.makedirs(osp.dirname(save_path), exist_ok=True)
-                    shutil.copy(s.fullpath, save_path)
-
-            for s in series:
-                target = osp.join(tmp_series_dir, osp.basename(s.fullpath))
-                os.makedirs(osp.dirname(target), exist_ok=True)
-                shutil.copy(s.fullpath, target)
-
-            named3dmask = dict()
-
-            for img_idx, image in enumerate(roi_data['Images']):
-                assert h == image["ImageHeight"] and w == image["ImageWidth"]
-
-                rois = image['ROIs']
-                if len(rois) == 0:
-                    warn(f"No ROI found in image #{img_idx} of {js}.")
-                    continue
-
-                assert SeriesInstanceUID == rois[0]["SeriesInstanceUID"]
-
-                rtstruct = RTStructBuilder.create_new(dicom_series_path=tmp_series_dir)
-                for roi_idx, roi in enumerate(rois):
-                    SOPInstanceUID = roi["SOPInstanceUID"]
-                    slice = SOPInstanceUID_lookup_table[roi["SOPInstanceUID"]]
-
-                    if series[-1].ImagePositionPatient[2] < series[0].ImagePositionPatient[2]:
-                        slice_idx = len(series) - slice.InstanceNumber
-                    else:
-                        slice_idx = slice.InstanceNumber
-
-                    assert roi["SeriesInstanceUID"] == SeriesInstanceUID
-
-                    roi_name =  roi["Name"]                    
-                    points = np.array([eval(point) for point in roi['Point_px']])
-
-                    if roi_name not in named3dmask:
-                        named3dmask[roi_name] = np.zeros((h, w, len(series)), dtype=bool)
-
-                    mask1 = np.zeros((h, w), dtype=np.uint8)
-                    cv2.fillPoly(mask1, [points.astype(np.int32)], color=1)
-                    named3dmask[roi_name][:, :, slice_idx] = mask1
-
-                    if args.save_to is not None:
-                        relpath = osp.relpath(slice.fullpath, start=data_dir)
-                        save_path = osp.join(args.save_to, relpath)
-
-                    if True and args.save_to is not None:
-                        # visualization
-                        img = normalize(dcmread(slice.fullpath).pixel_array, 0, 1)
-                        img = np.stack([img] * 3, axis=-1)
-                        red = np.zeros_like(img)
-                        red[:, :, -1] = 1
-                        alpha = 0.3
-                        overlay = red * mask1[:, :, None] * alpha + img * (1 - alpha)
-                        overlay = normalize(overlay, 0, 255).astype(np.uint8)
-                        
-                        cv2.imwrite(f"{save_path}.{roi_name}.overlay.jpg", overlay)
-                        #
-                        np.save(f"{save_path}.{roi_name}.npy", mask1)
-                        cv2.imwrite(f"{save_path}.{roi_name}_mask.png", mask1 * 255)
-                    #
-                    # print(f"Series {series_prefix}: ROI {roi_name} on slice #{slice_idx+1}.")
-
-            for name, mask in named3dmask.items():
-                rtstruct.add_roi(mask=mask, name="kai_"+name, approximate_contours=False)
-            rtstruct.save(osp.join(study_prefix, SeriesInstanceUID+"_rtstruct.dcm"))
+            series2jsons.setdefault(roi_data.SeriesInstanceUID, []).append(roi_data)
+
+        for SeriesInstanceUID, roi_datas in series2jsons.items():
+            series = series_instance_uid2series[SeriesInstanceUID]
+            assert all(r.h == roi_datas[0].h and r.w == roi_datas[0].w for r in roi_datas)
+            jobs.append(dotdict(
+                SeriesInstanceUID=SeriesInstanceUID,
+                study_instance_uid=study_instance_uid,
+                geometry=SeriesGeometry(series),
+                series_prefix=get_common_prefix([s.fullpath for s in series]),
+                study_prefix=study_prefix,
+                h=roi_datas[0].h,
+                w=roi_datas[0].w,
+                rois=[roi for r in roi_datas for roi in r.rois],
+                data_dir=data_dir,
+                save_to=save_to,
+                polygon=polygon,
+                overlay_every=overlay_every,
+                stage=stage,
+                tracer=tracer))
+
+    for roi_datas in study2jsons.values():
+        for roi_data in roi_datas:
+            warn(f"json {roi_data.json} does not correspond to any study in {data_dir}.")
+
+    failures = []
+    for _, job, save_path, error in run_jobs(convert_series, jobs, num_workers=num_workers,
+                                             max_in_flight=max_in_flight, ordered=ordered):
+        if error is not None:
+            failures.append((job.series_prefix, error))
+        else:
+            print(f"Saved structure set to \"{save_path}\"")
+    warn_failed_jobs(failures, len(jobs))
+    return failures
 
 
-if __name__ == "__main__":
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
     if not osp.isdir(args.dicom):
         raise RuntimeError(f'{args.dicom} is not a directory')
     if args.dicom == '/':
         warn("You are searching dicoms in the root directory, this might be EXTREMELY time-consuming. Consider providing a more specific sub-directory.")
-    process(args.dicom)
+    tracer = tracer_from_args(args)
+    process(args.dicom, args.save_to, num_workers=args.workers, use_index=args.index, polygon=args.polygon,
+            max_in_flight=args.max_in_flight, ordered=args.ordered, overlay_every=args.overlay_every,
+            stage=args.stage, include=args.include, exclude=args.exclude, max_depth=args.max_depth, tracer=tracer)
+    tracer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,198 @@
+import os, csv, gzip, json, argparse
 import numpy as np
 import nibabel as nib
 import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
+from warnings import warn
 from rt_utils import RTStructBuilder
 from rt_utils.image_helper import get_pixel_to_patient_transformation_matrix
+from dicom_utils import dotdict
+from export import fill_label_map, label_map_dtype
+from scheduler import run_jobs, warn_failed_jobs
 
-# path to your dicom files
-dicom_dir = "example/DICOM/"
 
-# path to your dicom rt file
-rt_path="example/RTStructure/rtstruct.dcm"
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="rt2NIfTI",
+        usage="rt2NIfTI path/to/dicoms/ path/to/rtstruct.dcm | rt2NIfTI --batch cases.csv",
+        description="""Export dicom-rt structure sets and their image series to NIfTI.
+        The image volume is saved to `images.nii.gz` and every ROI to `ROI-<name>.nii.gz`,
+        or all ROIs to a single `labels.nii.gz` label map.
+        In batch mode every row of the csv is a case: dicom directory, rt structure set and (optional) output directory.
+        """
+        )
+    parser.add_argument('dicom', nargs='?', default=None)
+    parser.add_argument('rtstruct', nargs='?', default=None)
+    parser.add_argument('--batch', type=str, default=None,
+                        help='csv file listing the cases to export')
+    parser.add_argument('--save-to', type=str, default=None,
+                        help='output directory of a single case (default: parent of the dicom directory)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of cases exported at the same time')
+    parser.add_argument('--label-map', action='store_true',
+                        help='save all ROIs into a single label map instead of one mask per ROI')
+    parser.add_argument('--no-compress', action='store_true',
+                        help='write uncompressed .nii files')
+    parser.add_argument('--compress-level', type=int, default=6,
+                        help='gzip compression level of .nii.gz files')
+    parser.add_argument('--compress-threads', type=int, default=4,
+                        help='number of threads compressing the outputs of a case')
+    return parser.parse_args(argv)
 
 
-rtstruct = RTStructBuilder.create_from(
-    dicom_series_path=dicom_dir,
-    rt_struct_path=rt_path
-)
+def load_volume(series_data):
+    """
+    stack the pixel data of `series_data` into a preallocated (h, w, d) volume
+    """
+    volume = None
+    for i, ds in enumerate(series_data):
+        pixels = ds.pixel_array
+        if volume is None:
+            volume = np.empty(pixels.shape + (len(series_data),), dtype=pixels.dtype)
+        volume[:, :, i] = pixels
+    return volume
 
-affine = get_pixel_to_patient_transformation_matrix(rtstruct.series_data)
 
-roi_names = rtstruct.get_roi_names()
+def build_label_map(named_masks):
+    """
+    merge the (h, w, d) bool masks of `named_masks` (name -> mask) into a single label map,
+    ROI #i gets label i+1 and overlaps are resolved by `export.fill_label_map`.
+    Returns the label map and the label of every name.
+    """
+    mask = next(iter(named_masks.values()))
+    label_map = np.zeros(mask.shape, dtype=label_map_dtype(len(named_masks)))
+    labels = fill_label_map(label_map, named_masks)
+    return label_map, labels
 
-# save the pixel values into nifti
-pixel_data = [d.pixel_array[:, :, None] for d in rtstruct.series_data]
-pixel_data = np.concatenate(pixel_data, axis=-1)
 
-nifti_img = nib.Nifti1Image(pixel_data, affine=affine)
-nifti_img_path = osp.abspath(osp.join(dicom_dir, "..", "images.nii.gz"))
-nib.save(nifti_img, nifti_img_path)
-print(f"Images saved to f{nifti_img_path}.")
+class NiftiWriter(object):
+    """
+    save arrays as NIfTI images. Compressed outputs are serialized in memory
+    and gzipped by a pool of `num_threads` threads (zlib releases the GIL),
+    errors are raised when the writer is closed.
+    """
+    def __init__(self, compress=True, level=6, num_threads=4) -> None:
+        self.compress = compress
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.futures = []
 
+    def __enter__(self):
+        return self
 
-for name in roi_names:
-    mask = rtstruct.get_roi_mask_by_name(name).astype(np.float32)
-    nifti_mask = nib.Nifti1Image(mask, affine=affine)
-    nifti_mask_path = osp.abspath(osp.join(dicom_dir, "..", f"ROI-{name}.nii.gz"))
-    nib.save(nifti_mask, nifti_mask_path)
-    print(f"ROI saved to f{nifti_mask_path}.")
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_gz(self, img, path):
+        data = gzip.compress(img.to_bytes(), compresslevel=self.level, mtime=0)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def save(self, array, affine, path):
+        """
+        save `array` to `path` + (".nii.gz" or ".nii"), returns the full path
+        """
+        img = nib.Nifti1Image(array, affine=affine)
+        if self.compress:
+            path = f"{path}.nii.gz"
+            self.futures.append(self.executor.submit(self._write_gz, img, path))
+        else:
+            path = f"{path}.nii"
+            nib.save(img, path)
+        return path
+
+    def close(self):
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown()
+
+
+def export_case(job):
+    """
+    export the image volume and the ROIs of one rt structure set to `job.save_to`,
+    returns the paths of the written files
+    """
+    rtstruct = RTStructBuilder.create_from(dicom_series_path=job.dicom, rt_struct_path=job.rtstruct)
+    affine = get_pixel_to_patient_transformation_matrix(rtstruct.series_data)
+    os.makedirs(job.save_to, exist_ok=True)
+    paths = []
+    with NiftiWriter(compress=job.compress, level=job.compress_level, num_threads=job.compress_threads) as writer:
+        paths.append(writer.save(load_volume(rtstruct.series_data), affine, osp.join(job.save_to, "images")))
+        named_masks = dict()
+        for name in rtstruct.get_roi_names():
+            mask = rtstruct.get_roi_mask_by_name(name)
+            if job.label_map:
+                named_masks[name] = mask
+            else:
+                paths.append(writer.save(mask.astype(np.uint8), affine, osp.join(job.save_to, f"ROI-{name}")))
+        if job.label_map and len(named_masks) > 0:
+            label_map, labels = build_label_map(named_masks)
+            paths.append(writer.save(label_map, affine, osp.join(job.save_to, "labels")))
+            with open(osp.join(job.save_to, "labels.json"), 'w') as f:
+                json.dump(labels, f, indent=2)
+    return paths
+
+
+def read_batch(fn):
+    """
+    read the cases of a batch csv, each row is: dicom directory, rt structure set[, output directory]
+    """
+    cases = []
+    with open(fn, 'r', newline='') as f:
+        for row in csv.reader(f):
+            row = [x.strip() for x in row]
+            if len(row) == 0 or row[0] == '' or row[0].startswith('#'):
+                continue
+            if len(row) < 2:
+                raise ValueError(f"Expected \"dicom,rtstruct[,save_to]\" in {fn}, got {row}.")
+            cases.append((row[0], row[1], row[2] if len(row) > 2 and row[2] else None))
+    return cases
+
+
+def process(cases, num_workers=1, label_map=False, compress=True, compress_level=6, compress_threads=4):
+    """
+    export `cases`, a list of (dicom directory, rt structure set, output directory or None).
+    Returns the (case, reason) of cases failed to export.
+    """
+    jobs = []
+    for dicom, rtstruct, save_to in cases:
+        if save_to is None:
+            save_to = osp.abspath(osp.join(dicom, ".."))
+        jobs.append(dotdict(
+            dicom=dicom,
+            rtstruct=rtstruct,
+            save_to=save_to,
+            label_map=label_map,
+            compress=compress,
+            compress_level=compress_level,
+            compress_threads=compress_threads))
+
+    failures = []
+    for _, job, paths, error in run_jobs(export_case, jobs, num_workers=num_workers):
+        if error is not None:
+            failures.append((job.rtstruct, error))
+        else:
+            print(f"Exported {job.rtstruct} to {', '.join(paths)}.")
+    warn_failed_jobs(failures, len(jobs))
+    return failures
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.batch is not None:
+        cases = read_batch(args.batch)
+    elif args.dicom is not None and args.rtstruct is not None:
+        cases = [(args.dicom, args.rtstruct, args.save_to)]
+    else:
+        raise RuntimeError("Provide a dicom directory and an rt structure set, or a batch csv with --batch.")
+    if len(cases) == 0:
+        warn(f"No case found in {args.batch}.")
+    process(cases, num_workers=args.workers, label_map=args.label_map, compress=not args.no_compress,
+            compress_level=args.compress_level, compress_threads=args.compress_threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,21 @@
-import os, shutil, argparse, time
-from glob import glob
+import os, argparse
 import os.path as osp
 from warnings import warn
-import itertools, os, sys, re
-RT_UTILS=osp.join(osp.dirname(__file__), "rt-utils")
-sys.path.insert(0, RT_UTILS)
-from rt_utils import RTStructBuilder
+import itertools, re
 from rt_utils.utils import Polygon2D
-from osirix_parser import OsirixSRParser
-from tqdm import tqdm
-from pydicom import dcmread
-
+from rtstruct_utils import load_series_headers, create_rtstruct
+from osirix_parser import OsirixSRParser, STRUCTURED
+from dicom_index import open_dicom_index
+from scheduler import run_jobs, warn_failed_jobs
+from sparse_mask import SparseMask
+from geometry import SeriesGeometry
+from export import export_label_map, EXPORT_FORMATS
+from walker import collect_inputs, add_walk_arguments, DICOM, OSIRIX_SR
+from tracing import Tracer, add_trace_arguments, tracer_from_args, header_bytes
 from dicom_utils import (
+    dotdict,
     read_dicom_info,
-    group_study_into_series,
+    group_into_series,
     find_osirix_sr,
     osirix_get_reference_uid,
     group_into_studies,
@@ -21,7 +23,7 @@ from dicom_utils import (
     build_SOPInstanceUID_lookup_table)
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         prog="rtconvert",
         usage="rtconvert path/to/dicoms/",
@@ -31,96 +33,202 @@ def parse_args():
         """
         )
     parser.add_argument('dicom')
-    return parser.parse_args()
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes used to read dicom meta data and convert series')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='maximum number of series being converted at the same time (default: 2 x workers)')
+    parser.add_argument('--ordered', action='store_true',
+                        help='report converted series in a deterministic order')
+    parser.add_argument('--index', action='store_true',
+                        help='keep a persistent meta data index in the data directory and only re-read changed files')
+    parser.add_argument('--sr-parser', type=str, default='13.0.1', choices=['13.0.1', STRUCTURED],
+                        help=f'OsirixSR parser version, "{STRUCTURED}" decodes the embedded archive structurally')
+    add_walk_arguments(parser)
+    parser.add_argument('--export', type=str, default=None, choices=EXPORT_FORMATS,
+                        help='also save the ROIs of every series as a label map next to its structure set')
+    add_trace_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def plan_study(dicoms, series_instance_uid2series=None):
+    """
+    build the lookup tables of a single study from its own dicoms:
+    common path prefix, SOPInstanceUID lookup table, series, OsirixSR assigned to the series they annotate
+    and the geometry (see `SeriesGeometry`) of every annotated series.
+    All work is linear in the number of dicoms of the study.
+    """
+    study_prefix = get_common_prefix([dcm.fullpath for dcm in dicoms])
+    SOPInstanceUID_lookup_table = build_SOPInstanceUID_lookup_table(dicoms)
+    if series_instance_uid2series is None:
+        series_instance_uid2series = group_into_series(dicoms)
+    # find out all Osirix SR files
+    osirix_sr = find_osirix_sr(dicoms)
+
+    # eliminate all OsirixSR files without an associated dicom
+    associated = [osirix_get_reference_uid(osx) in SOPInstanceUID_lookup_table for osx in osirix_sr]
+    if not all(associated):
+        ignored = [osp.basename(osx.fullpath) for osx, ass in zip(osirix_sr, associated) if ass is False]
+        ignored_str = ", ".join(ignored)
+        warn(f"study \"{study_prefix}\" OsirixSR \"{ignored_str}\" ignored due to unable to find associated dicom")
+        osirix_sr = list(itertools.compress(osirix_sr, associated))
+
+    # assign Osirix SR files to series
+    # Osirix SR annotations might be annotated on different series, e.g. ADC and T2.
+    series_instance_uid2osirixsr = dict()
+    for osx in osirix_sr:
+        series_instance_uid = SOPInstanceUID_lookup_table[osirix_get_reference_uid(osx)].SeriesInstanceUID
+        if series_instance_uid in series_instance_uid2osirixsr:
+            series_instance_uid2osirixsr[series_instance_uid].append(osx)
+        else:
+            series_instance_uid2osirixsr[series_instance_uid] = [osx]
+    return dotdict(
+        prefix=study_prefix,
+        SOPInstanceUID_lookup_table=SOPInstanceUID_lookup_table,
+        series=series_instance_uid2series,
+        osirix_sr=series_instance_uid2osirixsr,
+        geometry={uid: SeriesGeometry(series_instance_uid2series[uid]) for uid in series_instance_uid2osirixsr})
+
+
+def plan_jobs(studies, index=None, sr_parser='13.0.1', export=None, tracer=None):
+    """
+    one job (see `convert_series`) per annotated series of `studies` (StudyInstanceUID -> dicoms),
+    every study is planned from its own dicoms (see `plan_study`) so the total work is linear in the cohort size.
+    With a dicom `index` the series of a study are taken from it.
+    """
+    tracer = Tracer() if tracer is None else tracer
+    jobs = []
+    for study_instance_uid, study_dicoms in studies.items():
+        with tracer.span("plan_study", study=study_instance_uid):
+            study = plan_study(study_dicoms, index.series(study_instance_uid) if index is not None else None)
+
+        for series_instance_uid, osirix_sr in study.osirix_sr.items():
+            geometry = study.geometry[series_instance_uid]
+            # OsirixSR ordered by the slice they annotate
+            annotated = sorted([(geometry.index[osirix_get_reference_uid(osx)], osx) for osx in osirix_sr], key=lambda x: x[0])
+            jobs.append(dotdict(
+                study_instance_uid=study_instance_uid,
+                series_instance_uid=series_instance_uid,
+                study_prefix=study.prefix,
+                geometry=geometry,
+                osirix_sr=[osx for _, osx in annotated],
+                slice_indices=[z for z, _ in annotated],
+                sr_parser=sr_parser,
+                export=export,
+                tracer=tracer))
+    return jobs
+
 
+def convert_series(job):
+    """
+    convert the OsirixSR annotations on one series into a dicom-rt structure set.
+    `job` holds the geometry of the series, its OsirixSR (with the index of the slices they refer to)
+    and where to save the result. Returns the path of the saved structure set, or None if there is no ROI.
+    """
+    with job.tracer.span("series", study=job.study_instance_uid, series=job.series_instance_uid):
+        return _convert_series(job, job.tracer)
 
-def process(data_dir):
-    osirix_parser = OsirixSRParser()
+
+def _convert_series(job, tracer):
+    osirix_parser = OsirixSRParser(version=job.sr_parser)
+    series = job.geometry.slices
+    try:
+        with tracer.span("load_headers", series=job.series_instance_uid) as span:
+            series_data = load_series_headers(series, StudyID=job.study_instance_uid)
+            span.files += len(series)
+            span.bytes_read += header_bytes(series)
+        rtstruct = create_rtstruct(series_data)
+    except Exception as e:
+        raise RuntimeError(f"Cannot create RTStructure for series {job.series_instance_uid}: {e}")
+    h, w = int(series_data[0].Rows), int(series_data[0].Columns)
+    named_rois = dict()
+    # name -> slice index -> coords, only kept for the label map export
+    named_coords = dict()
+    with tracer.span("sr_parsing", series=job.series_instance_uid) as span:
+        for osx, roi_idx in zip(job.osirix_sr, job.slice_indices):
+            rois = osirix_parser(osx)
+            span.rois += len(rois)
+            for roi in rois:
+                span.points += len(roi.coords)
+                if job.export is not None:
+                    named_coords.setdefault(roi.name, dict())[roi_idx] = roi.coords
+                if roi.name in named_rois:
+                    named_rois[roi.name][roi_idx] = Polygon2D(coords=roi.coords.flatten().tolist(), h=h, w=w)
+                else:
+                    named_rois[roi.name] = [Polygon2D(coords=[], h=h, w=w)] * len(series)
+                    named_rois[roi.name][roi_idx] = Polygon2D(coords=roi.coords.flatten().tolist(), h=h, w=w)
+    if len(named_rois) == 0:
+        return None
+    with tracer.span("rt_build", series=job.series_instance_uid) as span:
+        for name, roi in named_rois.items():
+            rtstruct.add_roi(polygon=roi, name=name)
+        span.rois += len(named_rois)
+    filename = series[0].SeriesDescription.replace(" ", "-").replace('/', '-').replace('\\', '-')
+    filename = re.sub(r'-+', '-', filename) + '_rtstruct.dcm'
+    save_path = osp.join(job.study_prefix, "RTStructure", filename)
+    os.makedirs(osp.dirname(save_path), exist_ok=True)
+    with tracer.span("rt_save", series=job.series_instance_uid) as span:
+        rtstruct.save(save_path)
+        span.files += 1
+        span.bytes_written += osp.getsize(save_path)
+    if job.export is not None:
+        with tracer.span("export", series=job.series_instance_uid, format=job.export) as span:
+            named3dmask = dict()
+            for name, coords in named_coords.items():
+                named3dmask[name] = SparseMask(h, w, len(series))
+                for roi_idx, c in coords.items():
+                    named3dmask[name].fill_poly(roi_idx, c)
+            export_path = export_label_map(named3dmask, rtstruct.series_data, save_path[:-len('_rtstruct.dcm')] + '_labels', fmt=job.export)
+            span.files += 1
+            span.bytes_written += osp.getsize(export_path)
+    return save_path
+
+
+def process(data_dir, num_workers=1, use_index=False, sr_parser='13.0.1', max_in_flight=None, ordered=False,
+            export=None, include=None, exclude=None, max_depth=None, tracer=None):
+    tracer = Tracer() if tracer is None else tracer
     print(f"Searching dicom files in {data_dir}, this may take a while.")
-    dicoms = glob(f"{data_dir}/**/*.dcm", recursive=True)
+    with tracer.span("walk") as span:
+        inputs = collect_inputs(data_dir, [DICOM, OSIRIX_SR], include=include, exclude=exclude, max_depth=max_depth)
+        dicoms = sorted(inputs[DICOM] + inputs[OSIRIX_SR])
+        span.files += len(dicoms)
     if len(dicoms) == 0:
         raise RuntimeError(f"no dicom file found in {data_dir}")
     else:
         print(f"Found {len(dicoms)} dicom files, gathering their meta data.")
-    dicom_info = read_dicom_info(dicoms)
-    studies = group_into_studies(dicom_info)
-    for study_instance_uid, dicoms in studies.items():
-        dicom_paths = [dcm.fullpath for dcm in dicom_info]
-        study_prefix = get_common_prefix(dicom_paths)
-        SOPInstanceUID_lookup_table = build_SOPInstanceUID_lookup_table(dicom_info)
-        series_instance_uid2series = group_study_into_series(dicom_info)
-        # find out all Osirix SR files
-        osirix_sr = find_osirix_sr(dicom_info)
-
-        # eliminate all OsirixSR files without an associated dicom
-        associated = [osirix_get_reference_uid(osx) in SOPInstanceUID_lookup_table for osx in osirix_sr]
-        if not all(associated):
-            ignored = [osp.basename(osx.fullpath) for osx, ass in zip(osirix_sr, associated) if ass is False]
-            ignored_str = ", ".join(ignored)
-            warn(f"study \"{study_prefix}\" OsirixSR \"{ignored_str}\" ignored due to unable to find associated dicom")
-            osirix_sr = list(itertools.compress(osirix_sr, associated))
-
-        # assign Osirix SR files to series
-        # Osirix SR annotations might be annotated on different series, e.g. ADC and T2.
-        series_instance_uid2osirixsr = dict()
-        for osx in osirix_sr:
-            series_instance_uid = SOPInstanceUID_lookup_table[osirix_get_reference_uid(osx)].SeriesInstanceUID
-            if series_instance_uid in series_instance_uid2osirixsr:
-                series_instance_uid2osirixsr[series_instance_uid].append(osx)
-            else:
-                series_instance_uid2osirixsr[series_instance_uid] = [osx]
-
-        for series_instance_uid, osirix_sr in series_instance_uid2osirixsr.items():
-            series = sorted(series_instance_uid2series[series_instance_uid], key=lambda x:x['fullpath'])
-            osirix_sr = sorted(osirix_sr, key=lambda x : SOPInstanceUID_lookup_table[osirix_get_reference_uid(x)].InstanceNumber)
-            tmp_dir = osp.join('/tmp/OsirixSR2dicomrt', f'study-{study_instance_uid}/series-{series_instance_uid}')
-            os.makedirs(tmp_dir, exist_ok=True)
-            for ds in series:
-                fullpath = ds.fullpath
-                ds = dcmread(fullpath)
-                try:
-                    ds.pixel_array
-                except:
-                    warn(f"\"{fullpath}\" cannot access pixel_array")
-                fn = osp.basename(fullpath)
-                if not hasattr(ds, 'StudyID'):
-                    ds.StudyID = study_instance_uid
-                ds.save_as(osp.join(tmp_dir, fn))
-            #
-            try:
-                rtstruct  = RTStructBuilder.create_new(dicom_series_path=tmp_dir)
-            except:
-                warn(f"Cannot create RTStructure for {tmp_dir}")
-                continue
-            h, w = dcmread(series[0].fullpath).pixel_array.shape
-            named_rois = dict()
-            up_side_down = series[-1].ImagePositionPatient[2] < series[0].ImagePositionPatient[2]
-            for osx in osirix_sr:
-                instance_number = int(SOPInstanceUID_lookup_table[osirix_get_reference_uid(osx)].InstanceNumber)
-                roi_idx = len(series) - instance_number if up_side_down else instance_number - 1
-                rois = osirix_parser(dcmread(osx.fullpath))
-                for roi in rois:
-                    if roi.name in named_rois:
-                        named_rois[roi.name][roi_idx] = Polygon2D(coords=roi.coords.flatten().tolist(), h=h, w=w)
-                    else:
-                        named_rois[roi.name] = [Polygon2D(coords=[], h=h, w=w)] * len(series)
-                        named_rois[roi.name][roi_idx] = Polygon2D(coords=roi.coords.flatten().tolist(), h=h, w=w)
-            if len(named_rois) > 0:
-                for name, roi in named_rois.items():
-                    rtstruct.add_roi(polygon=roi, name=name)
-                filename = series[0].SeriesDescription.replace(" ", "-").replace('/', '-').replace('\\', '-')
-                filename = re.sub(r'-+', '-', filename) + '_rtstruct.dcm'
-                save_path = osp.join(study_prefix, "RTStructure", filename)
-                os.makedirs(osp.dirname(save_path), exist_ok=True)
-                print(f"Saved structure set to \"{save_path}\"")
-                rtstruct.save(save_path)
-                shutil.rmtree(tmp_dir)
+    with tracer.span("scan", index=use_index) as span:
+        if use_index:
+            index = open_dicom_index(data_dir, dicoms, num_workers=num_workers)
+            studies = index.studies()
+        else:
+            dicom_info = read_dicom_info(dicoms, num_workers=num_workers)
+            studies = group_into_studies(dicom_info)
+            span.files += len(dicom_info)
+            span.bytes_read += header_bytes(dicom_info)
 
+    jobs = plan_jobs(studies, index=index if use_index else None, sr_parser=sr_parser, export=export, tracer=tracer)
 
-if __name__ == "__main__":
-    args = parse_args()
+    failures = []
+    for _, job, save_path, error in run_jobs(convert_series, jobs, num_workers=num_workers,
+                                             max_in_flight=max_in_flight, ordered=ordered):
+        if error is not None:
+            failures.append((f"series {job.series_instance_uid}", error))
+        elif save_path is not None:
+            print(f"Saved structure set to \"{save_path}\"")
+    warn_failed_jobs(failures, len(jobs))
+
+
+def main(argv=None):
+    args = parse_args(argv)
     if not osp.isdir(args.dicom):
         raise RuntimeError(f'{args.dicom} is not a directory')
     if args.dicom == '/':
         warn("You are searching dicoms in the root directory, this might be EXTREMELY time-consuming. Consider providing a more specific sub-directory.")
-    process(args.dicom)
+    tracer = tracer_from_args(args)
+    process(args.dicom, num_workers=args.workers, use_index=args.index, sr_parser=args.sr_parser,
+            max_in_flight=args.max_in_flight, ordered=args.ordered, export=args.export,
+            include=args.include, exclude=args.exclude, max_depth=args.max_depth, tracer=tracer)
+    tracer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+from warnings import warn
+from rt_utils import ds_helper, image_helper
+from rt_utils.rtstruct import RTStruct
+from dicom_utils import read_dicom_header
+
+
+def load_series_headers(series, StudyID=None):
+    """
+    read the headers (everything but the pixel data) of the dicoms in `series`.
+    Dicoms without pixel data are ignored, `StudyID` is set on datasets that do not have one.
+    """
+    series_data = []
+    for s in series:
+        ds, offset, _ = read_dicom_header(s.fullpath, tags=None)
+        if offset is None:
+            warn(f"\"{s.fullpath}\" has no pixel data, ignored")
+            continue
+        if StudyID is not None and not hasattr(ds, 'StudyID'):
+            ds.StudyID = StudyID
+        series_data.append(ds)
+    return series_data
+
+
+def create_rtstruct(series_data):
+    """
+    same as `RTStructBuilder.create_new` but from already loaded datasets
+    instead of a directory of dicom files
+    """
+    if len(series_data) == 0:
+        raise Exception("No DICOM Images found in input series")
+    series_data = sorted(series_data, key=image_helper.get_slice_position)
+    ds = ds_helper.create_rtstruct_dataset(series_data)
+    return RTStruct(series_data, ds)
@@ -0,0 +1,56 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from warnings import warn
+
+
+def run_jobs(func, jobs, num_workers=1, max_in_flight=None, ordered=False):
+    """
+    run `func(job)` for every job in a process pool of `num_workers` processes,
+    with at most `max_in_flight` jobs submitted at the same time so that memory stays bounded.
+    Yields (index, job, result, error) as jobs finish, in the order of `jobs` if `ordered`.
+    A failed job yields its error message (and result None) instead of stopping the batch.
+    """
+    if num_workers <= 1:
+        for idx, job in enumerate(jobs):
+            try:
+                yield idx, job, func(job), None
+            except Exception as e:
+                yield idx, job, None, f"{type(e).__name__}: {e}"
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * num_workers
+    jobs = iter(enumerate(jobs))
+    pending = dict()
+    finished = dict()
+    next_idx = 0
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        while True:
+            for idx, job in jobs:
+                pending[executor.submit(func, job)] = (idx, job)
+                if len(pending) >= max_in_flight:
+                    break
+            if len(pending) == 0:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                idx, job = pending.pop(future)
+                try:
+                    finished[idx] = (idx, job, future.result(), None)
+                except Exception as e:
+                    finished[idx] = (idx, job, None, f"{type(e).__name__}: {e}")
+            if ordered:
+                while next_idx in finished:
+                    yield finished.pop(next_idx)
+                    next_idx += 1
+            else:
+                for idx in sorted(finished):
+                    yield finished.pop(idx)
+
+
+def warn_failed_jobs(failures, num_jobs):
+    """
+    summarize (job name, reason) of failed jobs in a single warning
+    """
+    if len(failures) > 0:
+        summary = "\n".join([f"  {name}: {reason}" for name, reason in failures])
+        warn(f"{len(failures)} of {num_jobs} jobs failed:\n{summary}")
@@ -0,0 +1,96 @@
+import numpy as np
+import cv2
+
+
+class SparseMask(object):
+    """
+    Binary (h, w, d) volume that only stores its non-empty slices,
+    each slice is cropped to its bounding box and bit-packed.
+    """
+    def __init__(self, h, w, d) -> None:
+        self.shape = (h, w, d)
+        # z -> (y0, x0, (bh, bw), packed bits)
+        self._slices = dict()
+
+    def __repr__(self) -> str:
+        return f"SparseMask(shape={self.shape}, slices={sorted(self._slices)})"
+
+    def __contains__(self, z):
+        return z in self._slices
+
+    def __len__(self):
+        return len(self._slices)
+
+    @property
+    def nbytes(self):
+        return sum(packed.nbytes for _, _, _, packed in self._slices.values())
+
+    def _store(self, z, y0, x0, crop):
+        ys = np.flatnonzero(crop.any(axis=1))
+        if len(ys) == 0:
+            self._slices.pop(z, None)
+            return
+        xs = np.flatnonzero(crop.any(axis=0))
+        crop = crop[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1]
+        self._slices[z] = (y0 + ys[0], x0 + xs[0], crop.shape, np.packbits(crop))
+
+    def _crop(self, z):
+        y0, x0, shape, packed = self._slices[z]
+        crop = np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+        return y0, x0, crop
+
+    def set_slice(self, z, mask):
+        """
+        replace slice `z` with the (h, w) `mask`
+        """
+        mask = np.asarray(mask, dtype=bool)
+        assert mask.shape == self.shape[:2], f"{mask.shape} v.s. {self.shape[:2]}"
+        self._store(z, 0, 0, mask)
+
+    def get_slice(self, z):
+        """
+        dense (h, w) bool mask of slice `z`
+        """
+        mask = np.zeros(self.shape[:2], dtype=bool)
+        if z in self._slices:
+            y0, x0, crop = self._crop(z)
+            mask[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1]] = crop
+        return mask
+
+    def fill_poly(self, z, points):
+        """
+        add the polygon `points` (N, 2) in pixel (x, y) to slice `z`, same as `cv2.fillPoly`
+        on the full slice but only the bounding box of the polygon is rasterized
+        """
+        h, w = self.shape[:2]
+        points = np.asarray(points).astype(np.int32).reshape(-1, 2)
+        x0, y0 = max(points[:, 0].min(), 0), max(points[:, 1].min(), 0)
+        x1, y1 = min(points[:, 0].max() + 1, w), min(points[:, 1].max() + 1, h)
+        if z in self._slices:
+            old_y0, old_x0, old = self._crop(z)
+            x0, y0 = min(x0, old_x0), min(y0, old_y0)
+            x1, y1 = max(x1, old_x0 + old.shape[1]), max(y1, old_y0 + old.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return
+        canvas = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        if z in self._slices:
+            canvas[old_y0 - y0:old_y0 - y0 + old.shape[0], old_x0 - x0:old_x0 - x0 + old.shape[1]] = old
+        cv2.fillPoly(canvas, [points - np.array([x0, y0], dtype=np.int32)], color=1)
+        self._store(z, y0, x0, canvas.astype(bool))
+
+    def slices(self):
+        """
+        iterate over (z, dense (h, w) mask) of the non-empty slices in ascending order
+        """
+        for z in sorted(self._slices):
+            yield z, self.get_slice(z)
+
+    def to_dense(self):
+        """
+        dense (h, w, d) bool volume, e.g. for `RTStruct.add_roi`
+        """
+        volume = np.zeros(self.shape, dtype=bool)
+        for z in self._slices:
+            y0, x0, crop = self._crop(z)
+            volume[y0:y0 + crop.shape[0], x0:x0 + crop.shape[1], z] = crop
+        return volume
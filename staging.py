@@ -0,0 +1,90 @@
+import os, shutil
+import os.path as osp
+
+
+# ioctl cloning a whole file on filesystems with reflinks (XFS, Btrfs), see `man ioctl_ficlone`
+FICLONE = 0x40049409
+
+STAGE_METHODS = ["auto", "hardlink", "reflink", "symlink", "copy"]
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    import fcntl
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        os.remove(dst)
+        raise
+
+
+def _symlink(src, dst):
+    os.symlink(osp.abspath(src), dst)
+
+
+def _copy(src, dst):
+    shutil.copy(src, dst)
+
+
+_STAGE_FUNCS = dict(hardlink=_hardlink, reflink=_reflink, symlink=_symlink, copy=_copy)
+
+
+class Stager(object):
+    """
+    place input files into an output tree with the cheapest method the filesystem supports.
+    `method="auto"` tries a hardlink, then a reflink and copies as a last resort,
+    any other method of `STAGE_METHODS` is used as is.
+    A file is staged at most once per destination, and a file that had to be copied
+    is hardlinked from its first copy when it is staged again elsewhere.
+    """
+    def __init__(self, method="auto") -> None:
+        if method not in STAGE_METHODS:
+            raise ValueError(f"Unknown staging method {method}, choose from {STAGE_METHODS}.")
+        self.method = method
+        # destination -> source
+        self.staged = dict()
+        # source -> destinations
+        self.copies = dict()
+
+    def _methods(self):
+        if self.method == "auto":
+            return ["hardlink", "reflink", "copy"]
+        return [self.method]
+
+    def stage(self, src, dst):
+        """
+        stage `src` at `dst` and return the method used, None if `dst` already is `src`
+        """
+        if self.staged.get(dst) == src:
+            return None
+        if osp.lexists(dst):
+            if osp.exists(dst) and osp.samefile(src, dst):
+                self.staged[dst] = src
+                return None
+            os.remove(dst)
+        os.makedirs(osp.dirname(osp.abspath(dst)), exist_ok=True)
+        error = None
+        for method in self._methods():
+            if method == "copy":
+                # link an earlier copy of the same file instead of copying it again
+                for copy in self.copies.get(src, []):
+                    try:
+                        _hardlink(copy, dst)
+                    except OSError:
+                        continue
+                    self.staged[dst] = src
+                    return "hardlink"
+            try:
+                _STAGE_FUNCS[method](src, dst)
+            except OSError as e:
+                error = e
+                continue
+            self.staged[dst] = src
+            if method == "copy":
+                self.copies.setdefault(src, []).append(dst)
+            return method
+        raise OSError(f"Cannot stage {src} to {dst} with {self.method}: {error}")
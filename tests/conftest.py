@@ -0,0 +1,5 @@
+import sys
+import os.path as osp
+
+# the modules of this repository live at its top level
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
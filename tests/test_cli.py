@@ -0,0 +1,24 @@
+import sys, json, subprocess
+import os.path as osp
+from benchmark import HEAVY_MODULES, IMPORT_ALLOWED
+
+
+REPO = osp.dirname(osp.dirname(osp.abspath(__file__)))
+
+
+def test_cli_imports_no_heavy_module():
+    """
+    `cli` only imports the module of a command when it runs, a fresh interpreter importing it
+    loads none of `HEAVY_MODULES`
+    """
+    code = (f"import sys, json, cli; print(json.dumps([{{k: v[0] for k, v in cli.COMMANDS.items()}}, "
+            f"[m for m in {HEAVY_MODULES} if m in sys.modules]]))")
+    # `-c` only puts the working directory on sys.path
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=REPO).stdout
+    commands, loaded = json.loads(out)
+    assert commands == dict(osirix="rtconvert", csv="csv2rt", json="roi2rt", nifti="rt2NIfTI", batch="batch_convert")
+    for module in commands.values():
+        assert osp.isfile(osp.join(REPO, f"{module}.py"))
+        # the import budget of every command is checked by `benchmark.py --check`
+        assert module in IMPORT_ALLOWED
+    assert loaded == []
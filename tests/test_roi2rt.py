@@ -0,0 +1,82 @@
+import os, json, glob
+import os.path as osp
+import numpy as np
+import pytest
+from rt_utils import RTStructBuilder
+from benchmark import write_synthetic_cohort
+from parse_roi import load_json
+from sparse_mask import SparseMask
+import roi2rt
+
+
+NUM_SLICES = 10
+SIZE = 64
+
+
+@pytest.fixture
+def cohort(tmp_path):
+    """
+    a single study with one annotated series of `NUM_SLICES` slices,
+    the json export annotates four slices with two ROIs each
+    """
+    return write_synthetic_cohort(str(tmp_path / "cohort"), num_studies=1, num_series=1,
+                                  num_slices=NUM_SLICES, num_sr=4, size=SIZE)
+
+
+def expected_masks(jsons):
+    """
+    name -> (h, w, d) bool mask of the ROIs of `jsons`, the synthetic series are stored in ascending order
+    so the slice index of an image is its position in the series
+    """
+    masks = dict()
+    for fn in jsons:
+        for roi in load_json(fn).rois:
+            mask = masks.setdefault(roi["Name"], SparseMask(SIZE, SIZE, NUM_SLICES))
+            mask.fill_poly(int(roi["SOPInstanceUID"].split(".")[-1]), roi["points_px"])
+    return {name: mask.to_dense() for name, mask in masks.items()}
+
+
+def read_rtstruct(cohort):
+    rtstructs = glob.glob(osp.join(cohort.root, "**", "*_rtstruct.dcm"), recursive=True)
+    assert len(rtstructs) == 1
+    series_dir = osp.dirname(cohort.dicoms[0])
+    return RTStructBuilder.create_from(dicom_series_path=series_dir, rt_struct_path=rtstructs[0])
+
+
+def assert_masks_match(rtstruct, expected):
+    assert sorted(rtstruct.get_roi_names()) == sorted("kai_" + name for name in expected)
+    for name, mask in expected.items():
+        converted = rtstruct.get_roi_mask_by_name("kai_" + name)
+        assert converted.shape == mask.shape
+        # same annotated slices
+        assert np.flatnonzero(converted.any(axis=(0, 1))).tolist() == np.flatnonzero(mask.any(axis=(0, 1))).tolist()
+        # contours are traced from the masks and filled again when read back, boundaries may move by a pixel
+        for z in np.flatnonzero(mask.any(axis=(0, 1))):
+            iou = (converted[:, :, z] & mask[:, :, z]).sum() / (converted[:, :, z] | mask[:, :, z]).sum()
+            assert iou > 0.9, f"{name} slice {z}: IoU {iou:.3f}"
+
+
+def test_roi2rt_matches_json(cohort):
+    failures = roi2rt.process(cohort.root, num_workers=1)
+    assert failures == []
+    assert_masks_match(read_rtstruct(cohort), expected_masks(cohort.jsons))
+
+
+def test_roi2rt_merges_jsons_of_a_series(cohort):
+    expected = expected_masks(cohort.jsons)
+    # split the export into two jsons annotating different slices of the same series
+    with open(cohort.jsons[0], "r") as f:
+        images = json.load(f)["Images"]
+    os.remove(cohort.jsons[0])
+    parts = []
+    for i, part in enumerate([images[:len(images) // 2], images[len(images) // 2:]]):
+        fn = osp.join(osp.dirname(cohort.jsons[0]), f"rois-{i}.json")
+        with open(fn, "w") as f:
+            json.dump(dict(Images=part), f)
+        parts.append(fn)
+    assert all(len(load_json(fn).rois) > 0 for fn in parts)
+
+    failures = roi2rt.process(cohort.root, num_workers=1)
+    assert failures == []
+    # a single structure set holds the ROIs of both jsons
+    assert_masks_match(read_rtstruct(cohort), expected)
@@ -0,0 +1,190 @@
+import os, sys, json, time, tempfile, threading, cProfile
+import os.path as osp
+from contextlib import contextmanager
+from dicom_utils import dotdict, get_logger
+
+
+TRACE_FORMATS = ["jsonl", "chrome"]
+
+# counters every span can increment, only non-zero counters are recorded
+COUNTERS = ["files", "bytes_read", "bytes_written", "pixel_decodes", "rois", "points"]
+
+
+def peak_rss():
+    """
+    peak resident set size of this process in bytes, None where `resource` is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def header_bytes(records):
+    """
+    bytes read to build the meta data `records`: everything up to the pixel data of images,
+    the whole file of dicoms without pixel data (e.g. OsirixSR)
+    """
+    total = 0
+    for r in records:
+        total += r.PixelDataOffset if r.PixelDataOffset is not None else osp.getsize(r.fullpath)
+    return total
+
+
+class Tracer(object):
+    """
+    record the wall time, cpu time, counters and peak RSS of (nested) spans of the pipelines.
+    Every finished span is appended as a json line to the events file, the tracer only holds
+    its settings so that jobs carry it to worker processes and their spans end up in the same file.
+    With `fmt="chrome"` the events are converted to a Chrome trace (chrome://tracing, Perfetto)
+    when the tracer is closed.
+
+    Spans whose name is in `profile` (or all spans for "all") run under cProfile,
+    their stats are dumped to `<profile_dir>/<name>-<pid>-<ns>.prof`.
+    With `log_file` the summary of every span is logged to it when the tracer is closed,
+    without `path` the events are then kept in a temporary file.
+    A tracer without `path`, `log_file` and `profile` records nothing.
+    """
+    def __init__(self, path=None, fmt="jsonl", profile=(), profile_dir="profiles", log_file=None) -> None:
+        if fmt not in TRACE_FORMATS:
+            raise ValueError(f"Unknown trace format {fmt}, choose from {TRACE_FORMATS}.")
+        self.path = path
+        self.fmt = fmt
+        self.profile = set(profile or [])
+        self.profile_dir = profile_dir
+        self.log_file = log_file
+        self.events_path = None
+        if path is not None:
+            self.events_path = path if fmt == "jsonl" else f"{path}.jsonl"
+            if osp.exists(self.events_path):
+                os.remove(self.events_path)
+        elif log_file is not None:
+            fd, self.events_path = tempfile.mkstemp(prefix="trace-", suffix=".jsonl")
+            os.close(fd)
+        self._profiling = False
+
+    @property
+    def enabled(self):
+        return self.events_path is not None or len(self.profile) > 0
+
+    def emit(self, event):
+        if self.events_path is None:
+            return
+        # a single write per line on a file opened for appending, lines of concurrent workers do not interleave
+        fd = os.open(self.events_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(event) + "\n").encode())
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        time the body of the `with` statement as span `name`, `args` (e.g. study or series uid) are recorded with it.
+        Yields a dotdict of `COUNTERS` for the body to increment.
+        """
+        counters = dotdict({k: 0 for k in COUNTERS})
+        if not self.enabled:
+            yield counters
+            return
+        profiler = None
+        if not self._profiling and ("all" in self.profile or name in self.profile):
+            profiler = cProfile.Profile()
+            self._profiling = True
+        ts, cpu, start = time.time(), time.process_time(), time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield counters
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(osp.join(self.profile_dir, f"{name}-{os.getpid()}-{time.perf_counter_ns()}.prof"))
+            self.emit(dict(
+                name=name,
+                ts=ts,
+                wall=time.perf_counter() - start,
+                cpu=time.process_time() - cpu,
+                pid=os.getpid(),
+                tid=threading.get_ident(),
+                args=args,
+                counters={k: v for k, v in counters.items() if v},
+                peak_rss=peak_rss()))
+
+    def events(self):
+        if self.events_path is None or not osp.exists(self.events_path):
+            return []
+        with open(self.events_path, 'r') as f:
+            return [json.loads(line) for line in f if len(line.strip()) > 0]
+
+    def summary(self, events=None):
+        """
+        totals per span name: number of spans, wall and cpu seconds, counters and the largest peak RSS
+        of `events`, by default the events recorded so far
+        """
+        summary = dict()
+        for e in (self.events() if events is None else events):
+            s = summary.setdefault(e["name"], dict(count=0, wall=0., cpu=0., peak_rss=None, **{k: 0 for k in COUNTERS}))
+            s["count"] += 1
+            s["wall"] += e["wall"]
+            s["cpu"] += e["cpu"]
+            for k, v in e["counters"].items():
+                s[k] += v
+            if e["peak_rss"] is not None:
+                s["peak_rss"] = max(s["peak_rss"] or 0, e["peak_rss"])
+        return summary
+
+    def close(self):
+        """
+        write the Chrome trace if requested and log the summary of every span to `log_file`
+        """
+        if self.events_path is None:
+            return
+        events = self.events()
+        if self.path is None:
+            # temporary events file of a tracer that only logs
+            os.remove(self.events_path)
+        elif self.fmt == "chrome":
+            t0 = min([e["ts"] for e in events], default=0)
+            trace = [dict(
+                name=e["name"],
+                cat="stage",
+                ph="X",
+                ts=(e["ts"] - t0) * 1e6,
+                dur=e["wall"] * 1e6,
+                pid=e["pid"],
+                tid=e["tid"],
+                args=dict(e["args"], cpu=e["cpu"], peak_rss=e["peak_rss"], **e["counters"])) for e in events]
+            with open(self.path, 'w') as f:
+                json.dump(dict(traceEvents=trace, displayTimeUnit="ms"), f)
+            os.remove(self.events_path)
+        if self.log_file is not None:
+            logger = get_logger(self.log_file)
+            for name, s in self.summary(events).items():
+                counters = ", ".join([f"{k}={s[k]}" for k in COUNTERS if s[k] > 0])
+                logger.info(f"{name}: {s['count']} spans, wall {s['wall']:.3f}s, cpu {s['cpu']:.3f}s"
+                            + (f", {counters}" if counters else "")
+                            + (f", peak rss {s['peak_rss'] / 2**20:.1f}MiB" if s["peak_rss"] else ""))
+
+
+def add_trace_arguments(parser):
+    parser.add_argument('--trace', type=str, default=None,
+                        help='record the time, cpu, I/O and memory of every stage, study and series to this file')
+    parser.add_argument('--trace-format', type=str, default='jsonl', choices=TRACE_FORMATS,
+                        help='json lines, or a Chrome trace viewable in chrome://tracing or Perfetto')
+    parser.add_argument('--profile', type=str, action='append', default=None,
+                        help='run this stage (span name, or "all") under cProfile, can be repeated')
+    parser.add_argument('--profile-dir', type=str, default='profiles',
+                        help='directory of the .prof files written by --profile')
+    parser.add_argument('--log-file', type=str, default=None,
+                        help='log the per-stage summary of the trace to this file')
+
+
+def tracer_from_args(args):
+    return Tracer(path=args.trace, fmt=args.trace_format, profile=args.profile, profile_dir=args.profile_dir,
+                  log_file=args.log_file)
@@ -0,0 +1,130 @@
+import os, struct
+import os.path as osp
+from fnmatch import fnmatch
+from warnings import warn
+from dicom_utils import dotdict
+
+
+# kinds of the entries yielded by `walk_inputs`
+DICOM = "dicom"
+OSIRIX_SR = "osirix_sr"
+RTSTRUCT = "rtstruct"
+ROI_CSV = "roi_csv"
+ROI_JSON = "roi_json"
+
+# only files with these suffixes are sniffed for the DICM magic, dicoms often have no suffix
+DICOM_SUFFIXES = (".dcm", ".dicom", ".ima", "")
+
+# SOP classes in the file meta information, OsirixSR are stored as structured reports
+SR_SOP_CLASS_PREFIX = b"1.2.840.10008.5.1.4.1.1.88."
+RTSTRUCT_SOP_CLASS = b"1.2.840.10008.5.1.4.1.1.481.3"
+
+PREAMBLE_LENGTH = 128
+# bytes read at once, enough for the file meta information of almost all dicoms
+HEAD_LENGTH = 1024
+
+
+def sniff_dicom(path):
+    """
+    classify a file from its first bytes: None if there is no 128-byte preamble followed by "DICM",
+    otherwise `OSIRIX_SR` or `RTSTRUCT` according to the SOP class in the file meta information, or `DICOM`.
+    OsirixSR are only candidates here, `dicom_utils.read_dicom_record` checks their EncapsulatedDocument.
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(HEAD_LENGTH)
+            if len(head) < PREAMBLE_LENGTH + 4 or head[PREAMBLE_LENGTH:PREAMBLE_LENGTH + 4] != b"DICM":
+                return None
+            # (0002,0000) UL FileMetaInformationGroupLength, always explicit VR little endian
+            meta_end = PREAMBLE_LENGTH + 4 + 12
+            if head[PREAMBLE_LENGTH + 4:PREAMBLE_LENGTH + 10] == b"\x02\x00\x00\x00UL":
+                meta_end += struct.unpack("<I", head[PREAMBLE_LENGTH + 12:PREAMBLE_LENGTH + 16])[0]
+            if meta_end > len(head):
+                head += f.read(meta_end - len(head))
+    except OSError:
+        return None
+    meta = head[PREAMBLE_LENGTH + 4:meta_end]
+    if SR_SOP_CLASS_PREFIX in meta:
+        return OSIRIX_SR
+    if RTSTRUCT_SOP_CLASS in meta:
+        return RTSTRUCT
+    return DICOM
+
+
+def classify(path):
+    """
+    kind of an input file by its suffix and, for dicom candidates, its first bytes
+    """
+    suffix = osp.splitext(path)[1].lower()
+    if suffix == ".csv":
+        return ROI_CSV
+    if suffix == ".json":
+        return ROI_JSON
+    if suffix in DICOM_SUFFIXES:
+        return sniff_dicom(path)
+    return None
+
+
+def _matches(relpath, patterns):
+    return any(fnmatch(relpath, p) or fnmatch(osp.basename(relpath), p) for p in patterns)
+
+
+def walk_inputs(root, include=None, exclude=None, max_depth=None, kinds=None):
+    """
+    walk `root` once with `os.scandir` and yield a dotdict(path, kind) for every input file,
+    see `classify`. Directories are visited in sorted order, hidden files and directories are skipped.
+
+    - include: glob patterns, only files whose relative path or name match one of them are considered
+    - exclude: glob patterns of files and directories to skip
+    - max_depth: do not descend more than `max_depth` directories below `root`
+    - kinds: only yield entries of these kinds
+    """
+    include = list(include or [])
+    exclude = list(exclude or [])
+    stack = [(root, 0)]
+    while len(stack) > 0:
+        path, depth = stack.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError as e:
+            warn(f"Cannot list {path}: {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            relpath = osp.relpath(entry.path, root)
+            if len(exclude) > 0 and _matches(relpath, exclude):
+                continue
+            if entry.is_dir():
+                if max_depth is None or depth < max_depth:
+                    subdirs.append((entry.path, depth + 1))
+                continue
+            if not entry.is_file():
+                continue
+            if len(include) > 0 and not _matches(relpath, include):
+                continue
+            kind = classify(entry.path)
+            if kind is not None and (kinds is None or kind in kinds):
+                yield dotdict(path=entry.path, kind=kind)
+        stack.extend(reversed(subdirs))
+
+
+def collect_inputs(root, kinds, include=None, exclude=None, max_depth=None):
+    """
+    paths of the inputs under `root` grouped by kind, every kind of `kinds` has a (possibly empty) list
+    """
+    inputs = {kind: [] for kind in kinds}
+    for entry in walk_inputs(root, include=include, exclude=exclude, max_depth=max_depth, kinds=kinds):
+        inputs[entry.kind].append(entry.path)
+    return inputs
+
+
+def add_walk_arguments(parser):
+    parser.add_argument('--include', type=str, action='append', default=None,
+                        help='only consider files matching this glob pattern (relative path or name), can be repeated')
+    parser.add_argument('--exclude', type=str, action='append', default=None,
+                        help='skip files and directories matching this glob pattern, can be repeated')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='maximum number of directory levels searched below the data directory')